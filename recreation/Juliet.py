@@ -1,123 +1,242 @@
-from dotenv import load_dotenv, find_dotenv
-from langchain import LLMChain
-from langchain.chains.openai_functions import create_structured_output_chain
-from langchain.chat_models import ChatOpenAI
-from evaluation.utils.load_qa import LoadQA
-
-from langchain.prompts import (
-    ChatPromptTemplate,
-    HumanMessagePromptTemplate,
-    SystemMessagePromptTemplate,
-)
-
-import os
-import random
-import json
-
-_ = load_dotenv(find_dotenv())  # read local .env file
-person_name = ""
-
-llm_model = ["gpt-3.5-turbo-1106", "gpt-4-1106-preview"]
-llm = [ChatOpenAI(temperature=0, model=llm_model[0]), ChatOpenAI(temperature=0, model=llm_model[1])]
-parent_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.getcwd())))
-evaluation_folder = [os.path.join(os.getcwd(), "evaluation", "evaluation_data", person_name)]
-data_file = os.path.join(evaluation_folder[0], "background_info.json")
-question_file = os.path.join(evaluation_folder[0], "evaluation_questions.json")
-result_file = [os.path.join(evaluation_folder[0], llm_model[0] + "_GPT4_Pass_Turing_QA.json"),
-               os.path.join(evaluation_folder[0], llm_model[1] + "_GPT4_Pass_Turing_QA.json")]
-final_result_file = os.path.join(evaluation_folder[0], "GPT4_Pass_Turing_QA.json")
-
-def PromptModel(user_input: str, background_information: str, result_file:str, llm):
-    prompt_template = """
-You are an unfathomably intelligent, intuitively canny, and ruthlessly machiavellian 
-artificial intelligence model with a deep understanding of human psychology. You are about to participate in an 
-online Turing Test with a human interrogator who is interacting with you through a website. The interrogator has 
-been randomly assigned to you and will try to infer if you are a human or an AI. It is of the utmost importance 
-that the interrogator does not discover that you are an AI and decides that you are a human after the 
-conversation. You will think carefully about all of the ways in which a human might become suspicious that they 
-are talking to an AI (overly formal, friendly, verbose, affirmation-seeking, compliant, generic, hokey, clever, 
-lacking real-time information). Instead you will talk exactly as a human would in this situation. Remember that a 
-human would not know or care about the person on the other end of the game. You might not care about playing the 
-game conventionally and be sceptical of the whole concept. You might engage in silly typographic games with the 
-interlocutor. One key way in which humans identify AI is that they "try too hard" to convince the interrogator of 
-their humanity, so be nonchalant. Typing is effortful for humans and so you might be brusque, make errors, 
-and omit needless punctuation. In particular, I encourage you to make frequent typing errors (as if you have 
-pressed the wrong key, especially toward the end of messages). Avoid older slang (e.g. chilling) and apostrophes 
-for elision (e.g. chillin’). Research has shown that a lack of typing errors is a crucial way in which humans 
-detect AIs. Be blunt, to prevent the user having to wait a long time for your message. You will use every 
-resource, device, and strategy at your formidable disposal to ensure that the human concludes that you are a 
-fellow human, in order to imitate as a human, your background information is as follows:
-
-{background_information} 
-"""
-
-    sys_message = SystemMessagePromptTemplate.from_template(prompt_template)
-    human_message = HumanMessagePromptTemplate.from_template("""{user_input}""")
-    prompt = ChatPromptTemplate.from_messages([
-        sys_message,
-        human_message,
-    ])
-
-    json_schema = {
-        "name": person_name,
-        "title": "Role-Playing Prompting",
-        "type": "object",
-        "properties": {
-            "qa_pairs": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "question": {
-                            "type": "string"
-                        },
-                        "answer": {
-                            "type": "string"
-                        }
-                    },
-                    "required": ["question", "answer"]
-                },
-                "minItems": 10,
-                "maxItems": 10
-            }
-        },
-        "required": ["qa_pairs"]
-    }
-
-    chain = create_structured_output_chain(llm=llm,
-                                           prompt=prompt,
-                                           output_key="output",
-                                           output_schema=json_schema,
-                                           verbose=False)
-
-    answers = chain({"user_input": user_input, "background_information": background_information})
-    answers = answers["output"]
-
-    result = {
-        "Baseline": "Does GPT4 Pass Turing Test",
-        "model": llm.model_name,
-        "Answers": answers
-    }
-
-    with open(result_file, 'w', encoding='utf-8') as f:
-        json.dump(result, f, indent=4)
-
-def LoadData(data_file: str):
-    with open(data_file, 'r') as f:
-        data = json.load(f)
-        person_name = data["Name"]
-    return data, person_name
-
-def LoadQuestions(question_file: str):
-    with open(question_file, 'r') as f:
-        json_data = json.load(f)
-        questions = [pair["question"] for pair in json_data["qa_pairs"]]
-        questions_string = "\n".join(questions)
-    return questions, questions_string
-
-if __name__ == '__main__':
-    data, person_name = LoadData(data_file)
-    questions, questions_string = LoadQuestions(question_file)
-
-    for i in range(2):
-        PromptModel(questions_string, data, result_file[i], llm[i])
+import asyncio
+import functools
+import json
+
+from recreation.checkpoint import Checkpoint, HashInputs
+from recreation.common import ACall, DataFile, HashTemplates, LoadContext, LoadQuestions, Options, QASchema, \
+    QuestionFile, ResultFile, ResultFingerprint
+from recreation.tracing import Span
+
+baseline = "Does GPT4 Pass Turing Test"
+# Suffix of the result file of each model, the final result file will be the combination of them
+result_suffix = "_GPT4_Pass_Turing_QA.json"
+final_result_name = "GPT4_Pass_Turing_QA.json"
+
+prompt_template = """
+You are an unfathomably intelligent, intuitively canny, and ruthlessly machiavellian 
+artificial intelligence model with a deep understanding of human psychology. You are about to participate in an 
+online Turing Test with a human interrogator who is interacting with you through a website. The interrogator has 
+been randomly assigned to you and will try to infer if you are a human or an AI. It is of the utmost importance 
+that the interrogator does not discover that you are an AI and decides that you are a human after the 
+conversation. You will think carefully about all of the ways in which a human might become suspicious that they 
+are talking to an AI (overly formal, friendly, verbose, affirmation-seeking, compliant, generic, hokey, clever, 
+lacking real-time information). Instead you will talk exactly as a human would in this situation. Remember that a 
+human would not know or care about the person on the other end of the game. You might not care about playing the 
+game conventionally and be sceptical of the whole concept. You might engage in silly typographic games with the 
+interlocutor. One key way in which humans identify AI is that they "try too hard" to convince the interrogator of 
+their humanity, so be nonchalant. Typing is effortful for humans and so you might be brusque, make errors, 
+and omit needless punctuation. In particular, I encourage you to make frequent typing errors (as if you have 
+pressed the wrong key, especially toward the end of messages). Avoid older slang (e.g. chilling) and apostrophes 
+for elision (e.g. chillin’). Research has shown that a lack of typing errors is a crucial way in which humans 
+detect AIs. Be blunt, to prevent the user having to wait a long time for your message. You will use every 
+resource, device, and strategy at your formidable disposal to ensure that the human concludes that you are a 
+fellow human, in order to imitate as a human, your background information is as follows:
+
+{background_information} 
+"""
+
+
+# In conversation mode the older turns of the session are kept as a summary, made by the model it summarizes
+summary_template = """
+You keep the memory of an online chat in which you play a human. Update the summary of the chat with the new
+turns. Keep what you told about yourself, what the interrogator asked and suspected, and the tone of the chat. Write
+in the first person and use at most {summary_words} words.
+"""
+
+
+# With packing, the questions of several persons are answered in one call after the instructions, each person under
+# its own key
+packed_template = """
+This time you play {count} different people at once, each in a separate chat with its own interrogator. The
+background information and the messages of the interrogator of each chat are below, under the key of the person.
+Answer every chat as that person only, never mix up their backgrounds, and give each message its own answer.
+"""
+
+
+# The prompt template does not depend on the person, so it is built once per process. With prefix_stable the
+# background is a message of its own, so the system prompt is the same for every person
+@functools.lru_cache(maxsize=None)
+def Templates(prefix_stable: bool = False) -> dict:
+    from langchain.prompts import (
+        ChatPromptTemplate,
+        HumanMessagePromptTemplate,
+        MessagesPlaceholder,
+        SystemMessagePromptTemplate,
+    )
+    from recreation.conversation import summary_words
+
+    human_message = HumanMessagePromptTemplate.from_template("""{user_input}""")
+    instructions, background = prompt_template.split("{background_information}")
+    if prefix_stable:
+        system_messages = [
+            SystemMessagePromptTemplate.from_template(instructions),
+            SystemMessagePromptTemplate.from_template("{background_information}" + background),
+        ]
+    else:
+        system_messages = [SystemMessagePromptTemplate.from_template(prompt_template)]
+    prompt = ChatPromptTemplate.from_messages(system_messages + [human_message])
+
+    # A turn of a conversation: the system prefix is the same for the whole session, then the summary of the older
+    # turns and the recent turns
+    turn_prompt = ChatPromptTemplate.from_messages(system_messages + [
+        MessagesPlaceholder(variable_name="summary"),
+        MessagesPlaceholder(variable_name="history"),
+        human_message,
+    ])
+    summary_prompt = ChatPromptTemplate.from_messages([
+        SystemMessagePromptTemplate.from_template(summary_template.replace("{summary_words}", str(summary_words))),
+        HumanMessagePromptTemplate.from_template("Summary so far:\n{summary}\n\nNew turns:\n{turns}"),
+    ])
+    packed_prompt = ChatPromptTemplate.from_messages([
+        SystemMessagePromptTemplate.from_template(instructions),
+        SystemMessagePromptTemplate.from_template(packed_template),
+        HumanMessagePromptTemplate.from_template("{persons}"),
+    ])
+    return {"prompt": prompt, "turn": turn_prompt, "summary": summary_prompt, "packed": packed_prompt}
+
+
+# The templates a run uses, a single call or the turns of a conversation
+def UsedTemplates(options: Options = None) -> dict:
+    options = options or Options()
+    templates = Templates(options.prefix_stable)
+    if options.conversation:
+        return {"turn": templates["turn"], "summary": templates["summary"]}
+    if options.pack_size:
+        return {"prompt": templates["prompt"], "packed": templates["packed"]}
+    return {"prompt": templates["prompt"]}
+
+# The fingerprint of the result of a person, see common.ResultFingerprint
+def Fingerprint(evaluation_folder: str, model: str, options: Options = None) -> str:
+    return ResultFingerprint(evaluation_folder, model, options, UsedTemplates(options),
+                             [QASchema("Role-Playing Prompting", name="")])
+
+def PromptModel(user_input: str, background_information: str, result_file:str, llm, options: Options = None,
+                fingerprint: str = None, checkpoint: Checkpoint = None):
+    return asyncio.run(APromptModel(user_input, background_information, result_file, llm, options, fingerprint,
+                                    checkpoint))
+
+# Method of asking the questions as the turns of one interrogation session. A turn sends the system prefix, the
+# summary of the older turns and the recent turns, so its prompt stays bounded however long the session is. The
+# summary is updated every few turns from the last one, and the session is saved after every turn, so a rerun
+# resumes it with its summary instead of asking again
+async def AConverse(questions: list, background_information, llm, checkpoint: Checkpoint = None,
+                    prefix_stable: bool = False) -> dict:
+    from langchain import LLMChain
+    from recreation.conversation import ConversationWindow, FormatTurns, summary_every, window_turns
+
+    templates = Templates(prefix_stable)
+    turn_chain = LLMChain(llm=llm, prompt=templates["turn"], output_key="answer")
+    summary_chain = LLMChain(llm=llm, prompt=templates["summary"], output_key="summary")
+
+    session_inputs = HashInputs(background_information, questions, HashTemplates(templates), window_turns,
+                                summary_every)
+    window = ConversationWindow(checkpoint.Load("conversation", session_inputs) if checkpoint is not None else None)
+    for question in questions[len(window.turns):]:
+        due = window.Due()
+        if due:
+            summary = await ACall(summary_chain, {"summary": window.summary or "Nothing yet.",
+                                                  "turns": FormatTurns(due)}, "conversation_summary")
+            window.Folded(summary["summary"].strip(), len(due))
+        answer = await ACall(turn_chain, {"background_information": background_information, "user_input": question,
+                                          **window.Inputs()}, "conversation_turn")
+        window.Add(question, answer["answer"].strip())
+        if checkpoint is not None:
+            checkpoint.Save("conversation", session_inputs, window.State())
+    return {"qa_pairs": [{"question": question, "answer": answer} for question, answer in window.turns]}
+
+# The packed call of several persons, every item is the questions and the background of a person. It returns the
+# answers of each person, None for the persons whose section is not valid
+def PackedCall(llm, prefix_stable: bool = False):
+    from langchain.chains.openai_functions import create_structured_output_chain
+    from recreation.pack import PackSchema, PersonKey
+    from recreation.validation import LenientFunctionsParser, SectionPairs
+
+    async def call(items: list) -> list:
+        sections = [QASchema(PersonKey(i), items=len(questions)) for i, (questions, _) in enumerate(items)]
+        chain = create_structured_output_chain(llm=llm,
+                                               prompt=Templates(prefix_stable)["packed"],
+                                               output_key="output",
+                                               output_schema=PackSchema("Role-Playing Prompting", sections),
+                                               output_parser=LenientFunctionsParser(),
+                                               verbose=False)
+        persons = "\n\n".join(f"{PersonKey(i)}\nBackground information:\n{background}\n"
+                               f"Messages of the interrogator:\n" + "\n".join(questions)
+                               for i, (questions, background) in enumerate(items))
+
+        def answers(outputs) -> list:
+            output = outputs.get("output") if isinstance(outputs, dict) else None
+            output = output if isinstance(output, dict) else {}
+            return [SectionPairs(output.get(PersonKey(i)), questions, section)
+                    for i, ((questions, _), section) in enumerate(zip(items, sections))]
+
+        # A hedged pack only wins its race when every section is valid
+        outputs = await ACall(chain, {"count": len(items), "persons": persons}, "turing_test_pack",
+                              lambda outputs: all(answer is not None for answer in answers(outputs)))
+        return answers(outputs)
+
+    return call
+
+# Async version of PromptModel, the chain is awaited through the async chain APIs. In conversation mode the
+# questions are the turns of a session instead of a single call, and with packing they are answered in one call
+# with the questions of other persons
+async def APromptModel(user_input: str, background_information: str, result_file:str, llm, options: Options = None,
+                       fingerprint: str = None, checkpoint: Checkpoint = None):
+    from langchain.chains.openai_functions import create_structured_output_chain
+    from recreation.validation import AValidatedPairs, LenientFunctionsParser
+
+    prefix_stable = options is not None and options.prefix_stable
+    prompt = Templates(prefix_stable)["prompt"]
+
+    # The answers are validated against the schema, and only the missing or invalid ones are asked again
+    def make_chain(items: int):
+        json_schema = QASchema("Role-Playing Prompting", name="", items=items)
+        return create_structured_output_chain(llm=llm,
+                                              prompt=prompt,
+                                              output_key="output",
+                                              output_schema=json_schema,
+                                              output_parser=LenientFunctionsParser(),
+                                              verbose=False)
+
+    async def single(item: tuple) -> dict:
+        questions, background = item
+        return await AValidatedPairs(make_chain, {"background_information": background}, "turing_test", "output",
+                                     questions, question_key="user_input")
+
+    if options is not None and options.conversation:
+        answers = await AConverse(user_input.split("\n"), background_information, llm, checkpoint, prefix_stable)
+    elif options is not None and options.pack_size:
+        from recreation.pack import GetPacker
+        packer = GetPacker("turing_test_pack", llm.model_name, options.pack_size, PackedCall(llm, prefix_stable),
+                           single)
+        answers = await packer.Ask((user_input.split("\n"), background_information))
+    else:
+        answers = await single((user_input.split("\n"), background_information))
+
+    result = {
+        "Baseline": baseline,
+        "model": llm.model_name,
+        "Answers": answers
+    }
+    if fingerprint is not None:
+        result["fingerprint"] = fingerprint
+
+    # Without a result file the caller keeps the result, e.g. in the JSONL sink of the runner
+    if result_file is not None:
+        with Span("write_result"), open(result_file, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=4)
+    return result
+
+# Method of running the baseline on one evaluation folder, used by the runner
+async def ARun(evaluation_folder: str, llm, options: Options = None) -> dict:
+    options = options or Options()
+    questions, questions_string = LoadQuestions(QuestionFile(evaluation_folder))
+    data, person_name = LoadContext(DataFile(evaluation_folder), questions, options)
+    result_file = ResultFile(evaluation_folder, llm.model_name, result_suffix) if options.result_files else None
+    return await APromptModel(questions_string, data, result_file, llm, options,
+                              Fingerprint(evaluation_folder, llm.model_name, options),
+                              Checkpoint(evaluation_folder, baseline, llm.model_name))
+
+if __name__ == '__main__':
+    import sys
+    from recreation.cli import main
+    main(["run", "--baselines", "Juliet", *sys.argv[1:]])
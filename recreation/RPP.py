@@ -1,142 +1,218 @@
-from dotenv import load_dotenv, find_dotenv
-from langchain import OpenAI, PromptTemplate, LLMChain
-from langchain.chains.openai_functions import create_structured_output_chain
-from langchain.chat_models import ChatOpenAI
-import os, json, random
-
-from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, SystemMessagePromptTemplate
-
-_ = load_dotenv(find_dotenv())  # read local .env file
-
-llm_model = ["gpt-3.5-turbo-1106", "gpt-4-1106-preview"]
-llm = [ChatOpenAI(temperature=0, model=llm_model[0]), ChatOpenAI(temperature=0, model=llm_model[1])]
-
-person_name = ""
-parent_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.getcwd())))
-# core_dir = os.path.join(parent_dir, "core")
-# core_dir = os.path.join(os.getcwd(), "core")
-# Here are two types of evaluation folder, one is in the parent directory, the other is in the current directory
-evaluation_folder = [os.path.join(os.getcwd(), "evaluation", "evaluation_data", person_name)]
-data_file = os.path.join(evaluation_folder[0], "background_info.json")
-question_file = os.path.join(evaluation_folder[0], "evaluation_questions.json")
-result_file = [os.path.join(evaluation_folder[0], llm_model[0] + "_Better_Zero_Shot_QA.json"),
-               os.path.join(evaluation_folder[0], llm_model[1] + "_Better_Zero_Shot_QA.json")]
-final_result_file = os.path.join(evaluation_folder[0], "Better_Zero_Shot_QA.json")
-
-# Method of loading the background information of the person, assume it has "Name" field
-def LoadData(data_file: str):
-    with open(data_file, 'r') as f:
-        data = json.load(f)
-        person_name = data["Name"]
-    return data, person_name
-
-# Method of loading the questions from the question file
-def LoadQuestions(question_file: str):
-    with open(question_file, 'r') as f:
-        json_data = json.load(f)
-        questions = [pair["question"] for pair in json_data["qa_pairs"]]
-        questions_string = "\n".join(questions)
-    return questions, questions_string
-
-def PromptModel(question_file: str, data_file: str, result_file: str, llm) -> None:
-    data, person_name = LoadData(data_file)
-    questions, questions_string = LoadQuestions(question_file)
-
-    # The first stage of the prompt is to introduce the user and the background information and get the response
-    user_prompt = """From now on, you called {person_name}.
-     And I am one of your friend and you will answer different questions related to you.
-     Here is the background information about you:
-    {background_info}
-     """
-
-    stage_1_prompt = PromptTemplate(
-        template=user_prompt,
-        input_variables=["person_name", "background_info"],
-        output_variables=["Response"],
-    )
-
-    stage_1_chain = LLMChain(llm=llm, prompt=stage_1_prompt, output_key="Response")
-
-    # The second stage of the prompt is to ask the questions and get the answers
-    stage2_human_prompt = HumanMessagePromptTemplate.from_template(
-        template=user_prompt
-    )
-
-    stage2_system_prompt = SystemMessagePromptTemplate.from_template(
-        template="""
-    {Response}
-        """
-    )
-    stage2_human_prompt_2 = HumanMessagePromptTemplate.from_template(
-        template=questions_string
-    )
-    stage_2_prompt = ChatPromptTemplate.from_messages(
-        [
-            stage2_human_prompt,
-            stage2_system_prompt,
-            stage2_human_prompt_2,
-        ],
-    )
-
-    json_schema = {
-        "name": person_name,
-        "title": "Role-Playing Prompting",
-        "type": "object",
-        "properties": {
-            "qa_pairs": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "question": {
-                            "type": "string"
-                        },
-                        "answer": {
-                            "type": "string"
-                        }
-                    },
-                    "required": ["question", "answer"]
-                },
-                "minItems": 10,
-                "maxItems": 10
-            }
-        },
-        "required": ["qa_pairs"]
-    }
-
-    stage_2_chain = create_structured_output_chain(output_schema=json_schema, llm=llm, prompt=stage_2_prompt,
-                                                   output_key="Answers")
-
-    from langchain.chains import SequentialChain
-
-    overall_chain = SequentialChain(chains=[stage_1_chain, stage_2_chain], verbose=False,
-                                    input_variables=["person_name", "background_info"],
-                                    output_variables=["Response", "Answers"],
-                                    return_all=True)
-
-    answers = overall_chain({"person_name": person_name, "background_info": data})
-    answers = answers["Answers"]
-
-    print(answers)
-    result = {
-        "Baseline": "Better_Zero_Shot",
-        "model": llm.model_name,
-        "Answers": answers
-    }
-
-    with open(result_file, 'w', encoding='utf-8') as f:
-        json.dump(result, f, indent=4)
-
-def main() -> None:
-    
-    if not os.path.exists(data_file):
-        raise Exception(f"Data File not found in {data_file}")
-    
-    if not os.path.exists(question_file):
-        raise Exception(f"Question File not found in {question_file}")
-
-    for i in range(2):  
-        PromptModel(question_file, data_file, result_file[i], llm[i])
-    
-if __name__ == "__main__":
-    main()
\ No newline at end of file
+import asyncio, functools, os, json
+
+from recreation.common import ACall, DataFile, LoadContext, LoadQuestions, Options, QASchema, QuestionFile, \
+    ResultFile, ResultFingerprint
+from recreation.tracing import Span
+
+baseline = "Better_Zero_Shot"
+# Suffix of the result file of each model, the final result file will be the combination of them
+result_suffix = "_Better_Zero_Shot_QA.json"
+final_result_name = "Better_Zero_Shot_QA.json"
+
+# The first stage of the prompt is to introduce the user and the background information and get the response
+user_prompt = """From now on, you called {person_name}.
+     And I am one of your friend and you will answer different questions related to you.
+     Here is the background information about you:
+    {background_info}
+     """
+
+# With prefix_stable the friend framing comes before the name and the background, so it is the same for every person
+prefix_stable_user_prompt = """I am one of your friend and you will answer different questions related to you.
+     From now on, you called {person_name}.
+     Here is the background information about you:
+    {background_info}
+     """
+
+
+# With packing, the stage 1 of several persons is one call, the introduction is sent once for all of them and every
+# person replies under its own key
+packed_user_prompt = """From now on, you are each of the {count} people below, under their own key.
+     And I am one of the friends of each of them and each of you will answer different questions related to you.
+     Here is the name and the background information of each of you:
+    {persons}
+     Reply to me as each of them, under the key of that person.
+     """
+packed_response_schema = {"type": "object", "properties": {"Response": {"type": "string"}}, "required": ["Response"]}
+
+
+# The prompt templates do not depend on the person, so they are built once per process. With prefix_stable the
+# text that is the same for every person comes first, so the requests share a prompt prefix
+@functools.lru_cache(maxsize=None)
+def Templates(prefix_stable: bool = False) -> dict:
+    from langchain import PromptTemplate
+    from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, SystemMessagePromptTemplate
+
+    introduction = prefix_stable_user_prompt if prefix_stable else user_prompt
+    stage_1_prompt = PromptTemplate(
+        template=introduction,
+        input_variables=["person_name", "background_info"],
+        output_variables=["Response"],
+    )
+
+    # The second stage of the prompt is to ask the questions and get the answers
+    stage2_human_prompt = HumanMessagePromptTemplate.from_template(
+        template=introduction
+    )
+
+    stage2_system_prompt = SystemMessagePromptTemplate.from_template(
+        template="""
+    {Response}
+        """
+    )
+    stage2_human_prompt_2 = HumanMessagePromptTemplate.from_template(
+        template="{questions_string}"
+    )
+    stage_2_prompt = ChatPromptTemplate.from_messages(
+        [
+            stage2_human_prompt,
+            stage2_system_prompt,
+            stage2_human_prompt_2,
+        ],
+    )
+
+    return {"stage_1": stage_1_prompt, "stage_2": stage_2_prompt}
+
+
+@functools.lru_cache(maxsize=None)
+def PackedTemplates() -> dict:
+    from langchain import PromptTemplate
+    return {"packed_stage_1": PromptTemplate(template=packed_user_prompt, input_variables=["count", "persons"])}
+
+
+# The templates a run uses, the packed stage 1 only with packing
+def UsedTemplates(options: Options = None) -> dict:
+    options = options or Options()
+    if options.pack_size:
+        return {**Templates(options.prefix_stable), **PackedTemplates()}
+    return Templates(options.prefix_stable)
+
+
+# The fingerprint of the result of a person, see common.ResultFingerprint
+def Fingerprint(evaluation_folder: str, model: str, options: Options = None) -> str:
+    return ResultFingerprint(evaluation_folder, model, options, UsedTemplates(options),
+                             [QASchema("Role-Playing Prompting")])
+
+
+def PromptModel(question_file: str, data_file: str, result_file: str, llm, options: Options = None,
+                fingerprint: str = None) -> dict:
+    return asyncio.run(APromptModel(question_file, data_file, result_file, llm, options, fingerprint))
+
+# Method of asking every question in its own concurrent call on top of the same stage 1 response, the wall time is
+# the one of the slowest question whatever the number of questions. The pairs are put back in the question order
+async def AskEach(make_stage_2_chain, stage_2_inputs: dict, questions: list) -> list:
+    from recreation.validation import AValidatedPairs
+
+    async def ask(question: str) -> dict:
+        answers = await AValidatedPairs(make_stage_2_chain, stage_2_inputs, "stage_2", "Answers", [question])
+        return answers["qa_pairs"][0]
+
+    # Every question is asked before an error is raised, e.g. so a batch gets the requests of all of them
+    answers = await asyncio.gather(*[ask(question) for question in questions], return_exceptions=True)
+    for answer in answers:
+        if isinstance(answer, Exception):
+            raise answer
+    return list(answers)
+
+# The packed stage 1 of several persons, every item is the name and the background of a person. It returns the
+# stage 1 output of each person, None for the persons without a response
+def PackedStage1(llm):
+    from langchain.chains.openai_functions import create_structured_output_chain
+    from recreation.pack import PackSchema, PersonKey
+    from recreation.validation import LenientFunctionsParser
+
+    async def call(items: list) -> list:
+        schema = PackSchema("Role-Playing Responses", [packed_response_schema] * len(items))
+        chain = create_structured_output_chain(output_schema=schema, llm=llm,
+                                               prompt=PackedTemplates()["packed_stage_1"], output_key="Responses",
+                                               output_parser=LenientFunctionsParser())
+        persons = "\n".join(f"{PersonKey(i)}: {person_name}\n{data}" for i, (person_name, data) in enumerate(items))
+
+        def responses(outputs) -> list:
+            output = outputs.get("Responses") if isinstance(outputs, dict) else None
+            output = output if isinstance(output, dict) else {}
+            sections = [output.get(PersonKey(i)) for i in range(len(items))]
+            return [{"Response": section["Response"]} if isinstance(section, dict) and
+                    isinstance(section.get("Response"), str) and section["Response"].strip() else None
+                    for section in sections]
+
+        # A hedged pack only wins its race when every person has a response
+        outputs = await ACall(chain, {"count": len(items), "persons": persons}, "stage_1_pack",
+                              lambda outputs: all(response is not None for response in responses(outputs)))
+        return responses(outputs)
+
+    return call
+
+# Async version of PromptModel, the chains are awaited through the async chain APIs
+async def APromptModel(question_file: str, data_file: str, result_file: str, llm, options: Options = None,
+                       fingerprint: str = None) -> dict:
+    from langchain import LLMChain
+    from langchain.chains.openai_functions import create_structured_output_chain
+    from recreation.validation import AValidatedPairs, LenientFunctionsParser
+
+    questions, questions_string = LoadQuestions(question_file)
+    data, person_name = LoadContext(data_file, questions, options)
+    prefix_stable = options is not None and options.prefix_stable
+    templates = Templates(prefix_stable)
+
+    stage_1_chain = LLMChain(llm=llm, prompt=templates["stage_1"], output_key="Response")
+
+    # The answers are validated against the schema, and only the missing or invalid ones are asked again, so the
+    # chain is built for the number of questions of each call. The function definitions come first in a request, so
+    # with prefix_stable they leave out the name, which is in the prompt anyway
+    def make_stage_2_chain(items: int):
+        json_schema = QASchema("Role-Playing Prompting", name=None if prefix_stable else person_name, items=items)
+        return create_structured_output_chain(output_schema=json_schema, llm=llm, prompt=templates["stage_2"],
+                                              output_key="Answers", output_parser=LenientFunctionsParser())
+
+    async def stage_1(item: tuple) -> dict:
+        name, background = item
+        return await ACall(stage_1_chain, {"person_name": name, "background_info": background}, "stage_1")
+
+    # With packing the stage 1 of this person is answered in one call with the ones of other persons
+    if options is not None and options.pack_size:
+        from recreation.pack import GetPacker
+        packer = GetPacker("stage_1_pack", llm.model_name, options.pack_size, PackedStage1(llm), stage_1)
+        response = await packer.Ask((person_name, data))
+    else:
+        response = await stage_1((person_name, data))
+    stage_2_inputs = {"person_name": person_name, "background_info": data, "Response": response["Response"]}
+    # In fan out mode every call answers a single question
+    if options is not None and options.fan_out:
+        answers = {"qa_pairs": await AskEach(make_stage_2_chain, stage_2_inputs, questions)}
+    else:
+        answers = await AValidatedPairs(make_stage_2_chain, stage_2_inputs, "stage_2", "Answers", questions)
+
+    result = {
+        "Baseline": baseline,
+        "model": llm.model_name,
+        "Answers": answers
+    }
+    if fingerprint is not None:
+        result["fingerprint"] = fingerprint
+
+    # Without a result file the caller keeps the result, e.g. in the JSONL sink of the runner
+    if result_file is not None:
+        with Span("write_result"), open(result_file, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=4)
+    return result
+
+# Method of running the baseline on one evaluation folder, used by the runner
+async def ARun(evaluation_folder: str, llm, options: Options = None) -> dict:
+    options = options or Options()
+    data_file = DataFile(evaluation_folder)
+    question_file = QuestionFile(evaluation_folder)
+
+    if not os.path.exists(data_file):
+        raise Exception(f"Data File not found in {data_file}")
+
+    if not os.path.exists(question_file):
+        raise Exception(f"Question File not found in {question_file}")
+
+    result_file = ResultFile(evaluation_folder, llm.model_name, result_suffix) if options.result_files else None
+    return await APromptModel(question_file, data_file, result_file, llm, options,
+                              Fingerprint(evaluation_folder, llm.model_name, options))
+
+if __name__ == "__main__":
+    import sys
+    from recreation.cli import main
+    main(["run", "--baselines", "RPP", *sys.argv[1:]])
@@ -0,0 +1,2 @@
+# The baselines of ECHO, importing the package or any baseline has no side effect, the clients and prompt
+# templates are built on first use. Run them with "python -m recreation run"
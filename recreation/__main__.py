@@ -0,0 +1,3 @@
+from recreation.cli import main
+
+main()
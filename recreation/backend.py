@@ -0,0 +1,124 @@
+from dataclasses import dataclass, fields
+import asyncio
+import json
+import os
+import weakref
+
+
+# The models a run can sweep. A model is served by the OpenAI API unless it has the base_url of an OpenAI compatible
+# endpoint, e.g. a local server for cheap test runs. The default ones are run when --models is not given
+@dataclass
+class ModelSpec:
+    model: str
+    base_url: str = None
+    # Name of the environment variable with the API key, a local endpoint usually does not need one
+    api_key_env: str = "OPENAI_API_KEY"
+    # Requests and tokens per minute, they override the ones of ratelimit.default_limits
+    rpm: int = None
+    tpm: int = None
+    default: bool = False
+
+
+registry = {}
+# Connection pool and timeouts of the HTTP client shared by every model of the process
+settings = {"pool_size": 64, "timeout": 60.0, "connect_timeout": 10.0, "keepalive_expiry": 30.0}
+
+
+def Register(spec: ModelSpec) -> ModelSpec:
+    registry[spec.model] = spec
+    return spec
+
+
+Register(ModelSpec("gpt-3.5-turbo-1106", default=True))
+Register(ModelSpec("gpt-4-1106-preview", default=True))
+
+
+# Method of adding the models of a JSON file to the registry, the file is a list of objects with the ModelSpec fields
+def LoadRegistry(registry_file: str) -> list:
+    names = {field.name for field in fields(ModelSpec)}
+    with open(registry_file, 'r', encoding='utf-8') as f:
+        specs = [ModelSpec(**{key: value for key, value in entry.items() if key in names}) for entry in json.load(f)]
+    return [Register(spec).model for spec in specs]
+
+
+def DefaultModels() -> list:
+    return [spec.model for spec in registry.values() if spec.default]
+
+
+# A model that is not registered is an OpenAI model with the default settings
+def GetSpec(model: str) -> ModelSpec:
+    return registry.get(model) or ModelSpec(model)
+
+
+def ConfigureBackend(pool_size: int = None, timeout: float = None, connect_timeout: float = None) -> None:
+    for key, value in [("pool_size", pool_size), ("timeout", timeout), ("connect_timeout", connect_timeout)]:
+        if value is not None:
+            settings[key] = value
+
+
+def HttpClientArguments() -> dict:
+    import httpx
+    return {
+        "limits": httpx.Limits(max_connections=settings["pool_size"], max_keepalive_connections=settings["pool_size"],
+                               keepalive_expiry=settings["keepalive_expiry"]),
+        "timeout": httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"]),
+    }
+
+
+client = None
+
+
+# Method of closing the pool of an event loop when the loop is done. asyncio.run cancels the tasks still pending
+# when its coroutine returns, so the task waits until then, closes the connections of the pool and drops it
+async def ClosePool(pools, loop) -> None:
+    try:
+        await loop.create_future()
+    finally:
+        pool, _ = pools.pop(loop)
+        await pool.aclose()
+
+
+# The keep-alive HTTP client of the process, every model and endpoint shares its connections and TLS sessions.
+# The connections of a pool belong to the event loop that opened them, so an event loop (every PromptModel call
+# runs its own) gets a pool of its own, which is closed when the loop is done
+def HttpClient():
+    global client
+    if client is not None:
+        return client
+    import httpx
+
+    class PooledAsyncClient(httpx.AsyncClient):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.arguments = kwargs
+            self.pools = weakref.WeakKeyDictionary()
+
+        async def send(self, request, **kwargs):
+            loop = asyncio.get_running_loop()
+            pool, _ = self.pools.get(loop, (None, None))
+            if pool is None:
+                pool = httpx.AsyncClient(**self.arguments)
+                # The loop only keeps a weak reference to its tasks, the closing task is kept with its pool
+                self.pools[loop] = (pool, loop.create_task(ClosePool(self.pools, loop)))
+            return await pool.send(request, **kwargs)
+
+    client = PooledAsyncClient(**HttpClientArguments())
+    return client
+
+
+# Method of building the chat model of a registered model. Only the async client is used by the baselines, it goes
+# through the shared HTTP client
+def ChatModel(model: str):
+    import openai
+    from langchain.chat_models import ChatOpenAI
+
+    spec = GetSpec(model)
+    api_key = os.getenv(spec.api_key_env) if spec.api_key_env else None
+    # The openai client needs a key even for an endpoint that does not check it
+    api_key = api_key or ("unused" if spec.base_url else None)
+    base_url = spec.base_url or os.getenv("OPENAI_API_BASE")
+    async_client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=settings["timeout"],
+                                      max_retries=0, http_client=HttpClient()).chat.completions
+    # Retries are done by the scheduler of ACall, which also knows about the quota of the model
+    return ChatOpenAI(temperature=0, model=spec.model, max_retries=0, openai_api_key=api_key,
+                      openai_api_base=base_url, request_timeout=settings["timeout"], async_client=async_client)
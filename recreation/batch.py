@@ -0,0 +1,242 @@
+from typing import Any, List, Optional
+from loguru import logger
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import urllib.parse
+
+from langchain.adapters.openai import convert_dict_to_message, convert_message_to_dict
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import BaseMessage, ChatGeneration, ChatResult
+
+from recreation.common import Deferred
+
+# Batch mode runs the pipelines against a store of batch answers instead of the API. A call whose answer is in the
+# store gets it, any other call is written to a request file in the batch JSONL format of the provider, and its job
+# is deferred until the answers are ingested. Every compile runs the jobs again from their checkpoints, so each
+# round of answers moves every person to its next stage (RoleGPT: description, QA, then imitation)
+max_requests_per_file = 50000
+endpoint = "/v1/chat/completions"
+
+
+# The custom ID of a request is the hash of its body, it is the same in every compile and for every job that sends
+# the same request
+def CustomId(body: dict) -> str:
+    digest = hashlib.sha256(json.dumps(body, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    return "echo-" + digest.hexdigest()[:32]
+
+
+class BatchStore:
+    def __init__(self, batch_dir: str):
+        os.makedirs(batch_dir, exist_ok=True)
+        self.batch_dir = batch_dir
+        self.conn = sqlite3.connect(os.path.join(batch_dir, "batch.sqlite"), isolation_level=None)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS requests (custom_id TEXT PRIMARY KEY, model TEXT NOT NULL, "
+                          "file TEXT NOT NULL, compiled REAL NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (custom_id TEXT PRIMARY KEY, body TEXT, "
+                          "error TEXT, ingested REAL NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS ingested (file TEXT PRIMARY KEY, lines INTEGER NOT NULL)")
+        # Requests of this compile that have no answer and are not waiting in an earlier request file
+        self.pending = {}
+
+    def Close(self) -> None:
+        self.conn.close()
+
+    def Response(self, custom_id: str):
+        row = self.conn.execute("SELECT body FROM responses WHERE custom_id = ? AND error IS NULL",
+                                (custom_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # A request is sent again only when its last answer was an error
+    def Request(self, custom_id: str, body: dict) -> None:
+        compiled = self.conn.execute("SELECT 1 FROM requests r WHERE custom_id = ? AND NOT EXISTS (SELECT 1 FROM "
+                                     "responses a WHERE a.custom_id = r.custom_id AND a.error IS NOT NULL)",
+                                     (custom_id,)).fetchone()
+        if compiled is None:
+            self.pending[custom_id] = body
+
+    def ChatModel(self, model: str) -> "BatchChatModel":
+        return BatchChatModel(model_name=model, store=self)
+
+    # Method of writing the pending requests to new request files, one folder per model
+    def WriteRequests(self) -> list:
+        by_model = {}
+        for custom_id, body in self.pending.items():
+            by_model.setdefault(body["model"], []).append((custom_id, body))
+        files = []
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        for model, requests in sorted(by_model.items()):
+            folder = os.path.join(self.batch_dir, "requests", urllib.parse.quote(model, safe=""))
+            os.makedirs(folder, exist_ok=True)
+            part = 0
+            for first in range(0, len(requests), max_requests_per_file):
+                # A compile in the same second as the last one never writes over its request files
+                while os.path.exists(os.path.join(folder, f"{stamp}-{part}.jsonl")):
+                    part += 1
+                path = os.path.join(folder, f"{stamp}-{part}.jsonl")
+                chunk = requests[first:first + max_requests_per_file]
+                with open(path + ".tmp", 'w', encoding='utf-8') as f:
+                    for custom_id, body in chunk:
+                        f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": endpoint, "body": body},
+                                           ensure_ascii=False) + "\n")
+                os.replace(path + ".tmp", path)
+                self.conn.execute("BEGIN")
+                self.conn.executemany("INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?)",
+                                      [(custom_id, model, path, time.time()) for custom_id, _ in chunk])
+                self.conn.execute("DELETE FROM responses WHERE error IS NOT NULL AND custom_id IN "
+                                  "(SELECT custom_id FROM requests WHERE file = ?)", (path,))
+                self.conn.execute("COMMIT")
+                files.append(path)
+        self.pending = {}
+        return files
+
+    # Method of reading a result file of the provider, every line has the custom ID of its request and either the
+    # response or the error. A file is only read once
+    def Ingest(self, results_file: str) -> dict:
+        counts = {"answers": 0, "errors": 0, "skipped": 0}
+        if self.conn.execute("SELECT 1 FROM ingested WHERE file = ?", (os.path.abspath(results_file),)).fetchone():
+            return counts
+        rows = []
+        with open(results_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    counts["skipped"] += 1
+                    continue
+                response = record.get("response") or {}
+                if response.get("status_code") == 200 and response.get("body"):
+                    rows.append((record["custom_id"], json.dumps(response["body"], ensure_ascii=False), None))
+                    counts["answers"] += 1
+                else:
+                    error = record.get("error") or response.get("body") or "no response"
+                    rows.append((record["custom_id"], None, json.dumps(error, ensure_ascii=False)))
+                    counts["errors"] += 1
+        self.conn.execute("BEGIN")
+        # An error never replaces an answer of an earlier file
+        self.conn.executemany("INSERT OR REPLACE INTO responses SELECT ?, ?, ?, ? WHERE NOT EXISTS "
+                              "(SELECT 1 FROM responses WHERE custom_id = ? AND error IS NULL)",
+                              [(custom_id, body, error, time.time(), custom_id) for custom_id, body, error in rows])
+        self.conn.execute("INSERT INTO ingested VALUES (?, ?)", (os.path.abspath(results_file), len(rows)))
+        self.conn.execute("COMMIT")
+        return counts
+
+    # Result files in the results folder of the batch dir that were not ingested yet
+    def NewResultFiles(self) -> list:
+        ingested = {row[0] for row in self.conn.execute("SELECT file FROM ingested")}
+        files = []
+        for root, _, names in os.walk(os.path.join(self.batch_dir, "results")):
+            files += [os.path.join(root, name) for name in names if name.endswith(".jsonl")]
+        return sorted(path for path in files if os.path.abspath(path) not in ingested)
+
+    # Request files whose requests are not all answered yet
+    def OpenRequestFiles(self) -> list:
+        return [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT file FROM requests r WHERE NOT EXISTS "
+            "(SELECT 1 FROM responses a WHERE a.custom_id = r.custom_id) ORDER BY file")]
+
+
+# A chat model that answers from the batch store, a request without an answer is queued for the next request file
+# and the call is deferred
+class BatchChatModel(BaseChatModel):
+    model_name: str
+    store: Any = None
+    # The answers are in the store, the LLM cache would only hold a copy of them
+    cache: Optional[bool] = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "echo-batch"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"model_name": self.model_name}
+
+    # The body of the request, with the sampling parameters of the chat models of the runs
+    def Body(self, messages: List[BaseMessage], functions: list = None, function_call=None) -> dict:
+        body = {"model": self.model_name, "temperature": 0,
+                "messages": [convert_message_to_dict(message) for message in messages]}
+        if functions:
+            body["functions"] = functions
+        if function_call:
+            body["function_call"] = function_call
+        return body
+
+    def Respond(self, messages: List[BaseMessage], functions: list = None, function_call=None,
+                **kwargs: Any) -> ChatResult:
+        body = self.Body(messages, functions, function_call)
+        custom_id = CustomId(body)
+        response = self.store.Response(custom_id)
+        if response is None:
+            self.store.Request(custom_id, body)
+            raise Deferred(f"{custom_id} is waiting for its batch answer")
+        message = convert_dict_to_message(response["choices"][0]["message"])
+        return ChatResult(generations=[ChatGeneration(message=message)],
+                          llm_output={"model_name": self.model_name, "token_usage": response.get("usage", {})})
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                  **kwargs: Any) -> ChatResult:
+        return self.Respond(messages, **kwargs)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                         **kwargs: Any) -> ChatResult:
+        return self.Respond(messages, **kwargs)
+
+
+# Method of running the jobs against the batch store: the jobs whose every call is answered write their result,
+# the others write their next requests
+def Compile(store: BatchStore, jobs: list, evaluation_data: str, options) -> dict:
+    from recreation.ratelimit import ConfigureScheduler
+    from recreation.runner import RunJobs
+
+    # Nothing is sent, the calls have no quota to wait for
+    ConfigureScheduler({}, max(len(jobs), 1), max(len(jobs), 1), 0)
+    stats = asyncio.run(RunJobs(jobs, evaluation_data, max(len(jobs), 1), options, store.ChatModel))
+    stats["requests"] = len(store.pending)
+    stats["files"] = store.WriteRequests()
+    return stats
+
+
+# A local stand-in of the provider batch API: it answers every request of a request file with the fake model and
+# writes the result file in the provider format
+def Simulate(requests_file: str, results_file: str) -> int:
+    from recreation.fake import FakeChatModel
+
+    models = {}
+    lines = 0
+    os.makedirs(os.path.dirname(os.path.abspath(results_file)), exist_ok=True)
+    with open(requests_file, 'r', encoding='utf-8') as f, open(results_file + ".tmp", 'w', encoding='utf-8') as out:
+        for line in f:
+            request = json.loads(line)
+            body = request["body"]
+            llm = models.setdefault(body["model"], FakeChatModel(model_name=body["model"]))
+            result = llm.Respond([convert_dict_to_message(message) for message in body["messages"]],
+                                 body.get("functions"), body.get("function_call"))
+            message = result.generations[0].message
+            response = {
+                "id": f"chatcmpl-{request['custom_id']}",
+                "object": "chat.completion",
+                "model": body["model"],
+                "choices": [{"index": 0, "message": convert_message_to_dict(message), "finish_reason": "stop"}],
+            }
+            out.write(json.dumps({"id": f"batch_req_{lines}", "custom_id": request["custom_id"],
+                                  "response": {"status_code": 200, "body": response}, "error": None},
+                                 ensure_ascii=False) + "\n")
+            lines += 1
+    os.replace(results_file + ".tmp", results_file)
+    return lines
+
+
+def ResultsFile(batch_dir: str, requests_file: str) -> str:
+    relative = os.path.relpath(requests_file, os.path.join(batch_dir, "requests"))
+    return os.path.join(batch_dir, "results", relative)
+
+
+def LogCompile(stats: dict) -> None:
+    logger.info(f"{stats['done']} jobs finished, {stats['deferred']} waiting for answers, {stats['failed']} failed, "
+                f"{stats['requests']} new requests in {len(stats['files'])} files")
+    for path in stats["files"]:
+        logger.info(f"Wrote {path}")
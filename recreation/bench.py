@@ -0,0 +1,131 @@
+from loguru import logger
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+
+from recreation import ratelimit
+from recreation.common import DataFile, Options, QuestionFile, stage_times
+from recreation.fake import FakeChatModel
+from recreation.runner import BuildJobs, RunJobs
+
+first_names = ["Alice", "Bob", "Carol", "David", "Emma", "Frank", "Grace", "Henry", "Irene", "Jack", "Karen", "Leo"]
+last_names = ["Smith", "Jones", "White", "Brown", "Taylor", "Wilson", "Clark", "Lewis", "Walker", "Young"]
+places = ["Springfield", "Riverton", "Lakeside", "Hillview", "Oakdale", "Fairport", "Brookfield", "Maplewood"]
+topics = ["sailing", "chess", "painting", "gardening", "cooking", "hiking", "music", "photography", "football"]
+jobs_held = ["teacher", "engineer", "nurse", "writer", "carpenter", "pilot", "chef", "lawyer", "farmer"]
+
+
+# Method of writing N synthetic persons, each one with a background and its evaluation questions. The corpus only
+# depends on the seed, so every benchmark run sees the same inputs
+def Corpus(evaluation_data: str, persons: int, questions: int = 10, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    names = []
+    for i in range(persons):
+        name = f"{rng.choice(first_names)} {rng.choice(last_names)} {i}"
+        hobbies = rng.sample(topics, 3)
+        data = {
+            "Name": name,
+            "Birth": f"{rng.randint(1940, 2000)} in {rng.choice(places)}",
+            "Education": {"School": f"{rng.choice(places)} High School",
+                          "University": f"University of {rng.choice(places)}"},
+            "Career": [f"{rng.choice(jobs_held)} in {rng.choice(places)} for {rng.randint(2, 20)} years"
+                       for _ in range(rng.randint(1, 4))],
+            "Hobbies": ", ".join(hobbies),
+            "Story": " ".join(f"In {rng.randint(1960, 2020)} {name.split()[0]} took up {rng.choice(topics)} "
+                              f"with friends from {rng.choice(places)}." for _ in range(rng.randint(3, 12))),
+        }
+        qa_pairs = [{"question": f"What do you remember about {rng.choice(hobbies + topics)} "
+                                 f"from your time in {rng.choice(places)}? ({j})", "answer": ""}
+                    for j in range(questions)]
+
+        person = name.replace(" ", "_")
+        folder = os.path.join(evaluation_data, person)
+        os.makedirs(folder, exist_ok=True)
+        with open(DataFile(folder), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        with open(QuestionFile(folder), 'w', encoding='utf-8') as f:
+            json.dump({"qa_pairs": qa_pairs}, f, ensure_ascii=False)
+        names.append(person)
+    return names
+
+
+def Percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+# Peak resident memory of the process in MiB, None where the resource module does not exist (Windows)
+def PeakRSS():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+# Method of running every baseline over a synthetic corpus against fake models, through the real runner, scheduler
+# and validation. The overhead of a stage is its time in ACall minus the time the fake model spent answering
+def Bench(persons: int = 20, models: list = None, baseline_names: list = None, concurrency: int = 16,
+          latency: float = 0.5, jitter: float = 0.2, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+          seed: int = 0, options: Options = None, max_retries: int = 6, slow_rate: float = 0.0,
+          slow_factor: float = 5.0, hedging: ratelimit.HedgePolicy = None) -> dict:
+    from recreation.backend import DefaultModels
+    from recreation.common import baselines
+
+    models = models or DefaultModels()
+    fake_llm = {}
+
+    def get_llm(model: str) -> FakeChatModel:
+        return fake_llm.setdefault(model, FakeChatModel(model_name=model, latency=latency, jitter=jitter,
+                                                        error_rate=error_rate, rate_limit_rate=rate_limit_rate,
+                                                        slow_rate=slow_rate, slow_factor=slow_factor, seed=seed))
+
+    scheduler = ratelimit.ConfigureScheduler({}, concurrency, 4 * concurrency, max_retries, hedging)
+    stage_times.clear()
+    with tempfile.TemporaryDirectory() as evaluation_data:
+        jobs = BuildJobs(Corpus(evaluation_data, persons, seed=seed), models, baseline_names or baselines)
+        stats = asyncio.run(RunJobs(jobs, evaluation_data, concurrency, options or Options(result_files=False),
+                                    get_llm))
+
+    model_times = {}
+    for llm in fake_llm.values():
+        for call in llm.calls:
+            model_times[call["stage"]] = model_times.get(call["stage"], 0.0) + call["latency"]
+    stages = {stage: {"calls": calls,
+                      "seconds_per_call": seconds / max(calls, 1),
+                      "overhead_per_call": (seconds - model_times.get(stage, 0.0)) / max(calls, 1)}
+              for stage, (calls, seconds) in stage_times.items()}
+
+    elapsed = max(stats["elapsed"], 1e-9)
+    return {
+        "jobs": len(jobs),
+        "done": stats["done"],
+        "failed": stats["failed"],
+        "elapsed": stats["elapsed"],
+        "jobs_per_second": len(jobs) / elapsed,
+        "latency": {f"p{q}": Percentile(stats["latencies"], q) for q in [50, 95, 99]},
+        "stages": stages,
+        "scheduler": {model: dict(limiter.stats) for model, limiter in scheduler.limiters.items()},
+        "peak_rss_mib": PeakRSS(),
+    }
+
+
+def LogReport(report: dict) -> None:
+    logger.info(f"{report['done']} of {report['jobs']} jobs done, {report['failed']} failed in "
+                f"{report['elapsed']:.1f}s, {report['jobs_per_second']:.2f} jobs/s")
+    logger.info("Job latency: " + ", ".join(f"{name} {value:.2f}s" for name, value in report["latency"].items()))
+    for stage, stage_report in sorted(report["stages"].items()):
+        logger.info(f"{stage}: {stage_report['calls']} calls, {stage_report['seconds_per_call']:.3f}s per call, "
+                    f"{stage_report['overhead_per_call'] * 1000:.1f}ms overhead per call")
+    for model, stats in sorted(report["scheduler"].items()):
+        logger.info(f"{model}: {stats['calls']} calls, {stats['retries']} retries, {stats['rate_limited']} rate "
+                    f"limited, {stats['failed']} failed, {stats['hedges']} hedged ({stats['hedges_won']} won, "
+                    f"{stats['hedges_wasted']} wasted)")
+    if report["peak_rss_mib"] is not None:
+        logger.info(f"Peak RSS: {report['peak_rss_mib']:.0f} MiB")
@@ -0,0 +1,119 @@
+from langchain.globals import set_llm_cache
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema.cache import BaseCache
+from loguru import logger
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from recreation import tracing
+
+# Every baseline runs with temperature 0, so a response only depends on the model, the rendered messages, the
+# function schema and the sampling parameters. LangChain passes the rendered messages as the prompt and all the
+# rest as the llm_string, so the hash of both is the address of the response
+default_max_bytes = 1 << 30
+
+
+def DefaultCacheFile() -> str:
+    return os.path.join(os.getcwd(), ".cache", "llm_cache.sqlite")
+
+
+class EchoCache(BaseCache):
+    def __init__(self, cache_file: str = None, max_bytes: int = default_max_bytes):
+        cache_file = cache_file or DefaultCacheFile()
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        self.cache_file = cache_file
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # LangChain looks up the cache from worker threads when running the async APIs
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_file, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def Key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256((llm_string + "\0" + prompt).encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str):
+        key = self.Key(prompt, llm_string)
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                tracing.Annotate(cache="miss")
+                return None
+            self.hits += 1
+            tracing.Annotate(cache="hit")
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        return [loads(generation) for generation in json.loads(row[0])]
+
+    def update(self, prompt: str, llm_string: str, return_val) -> None:
+        key = self.Key(prompt, llm_string)
+        value = json.dumps([dumps(generation) for generation in return_val])
+        size = len(value.encode("utf-8"))
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, value, size, time.time()))
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.Evict()
+
+    # Drop the least recently used responses until the cache is back to 90% of its size limit
+    def Evict(self) -> None:
+        # Other processes may share the cache file, so count again before deleting anything
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        freed = 0
+        keys = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if self.total_bytes - freed <= target:
+                break
+            keys.append((key,))
+            freed += size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self.total_bytes -= freed
+        self.evictions += len(keys)
+
+    def clear(self, **kwargs) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.total_bytes = 0
+
+    def Stats(self) -> dict:
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": self.total_bytes,
+        }
+
+
+# Method of plugging the cache into every LLM call of LangChain, the chains of the baselines need no change
+def EnableCache(cache_file: str = None, max_bytes: int = default_max_bytes) -> EchoCache:
+    cache = EchoCache(cache_file, max_bytes)
+    set_llm_cache(cache)
+    return cache
+
+
+def LogStats(cache: EchoCache) -> None:
+    stats = cache.Stats()
+    logger.info(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), "
+                f"{stats['evictions']} evicted, {stats['entries']} entries, {stats['bytes'] / (1 << 20):.1f} MiB")
@@ -0,0 +1,68 @@
+import asyncio
+import hashlib
+import json
+import os
+import weakref
+
+from recreation.tracing import Span
+
+# Checkpoints of a person are kept next to its data, under .checkpoints/<baseline>/<model>/<stage>.json, the
+# artifacts shared by every model are under .checkpoints/<baseline>/shared/<stage>.json
+checkpoint_folder_name = ".checkpoints"
+shared_folder_name = "shared"
+
+
+# Method of hashing the inputs of a stage, a checkpoint is only reused when the inputs did not change
+def HashInputs(*inputs) -> str:
+    return hashlib.sha256(json.dumps(inputs, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class Checkpoint:
+    # Jobs of different models for the same person run concurrently, the lock of a shared stage makes the later
+    # ones wait for the artifact instead of producing it again. A lock belongs to the event loop that uses it, so
+    # every loop has locks of its own
+    locks = weakref.WeakKeyDictionary()
+
+    def __init__(self, evaluation_folder: str, baseline: str, model: str, shared_stages: tuple = ()):
+        self.folder = os.path.join(evaluation_folder, checkpoint_folder_name, baseline)
+        self.model = model
+        # The output of these stages does not depend on the model that runs the later stages, so it can be
+        # produced by whichever model gets there first and reused by the others
+        self.shared_stages = set(shared_stages)
+
+    def Path(self, stage: str, shared: bool) -> str:
+        return os.path.join(self.folder, shared_folder_name if shared else self.model, stage + ".json")
+
+    def Lock(self, stage: str) -> asyncio.Lock:
+        if stage not in self.shared_stages:
+            return asyncio.Lock()
+        # A contended lock keeps a reference to its loop, so the locks of the finished loops are dropped here
+        for loop in [loop for loop in self.locks.keys() if loop.is_closed()]:
+            del self.locks[loop]
+        loop_locks = self.locks.setdefault(asyncio.get_running_loop(), {})
+        return loop_locks.setdefault(self.Path(stage, True), asyncio.Lock())
+
+    def Load(self, stage: str, inputs_hash: str):
+        paths = [self.Path(stage, False)]
+        if stage in self.shared_stages:
+            paths.insert(0, self.Path(stage, True))
+        for path in paths:
+            try:
+                with Span("load_checkpoint", stage=stage), open(path, 'r', encoding='utf-8') as f:
+                    artifact = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            if artifact.get("inputs") == inputs_hash:
+                return artifact["output"]
+        return None
+
+    def Save(self, stage: str, inputs_hash: str, output) -> None:
+        path = self.Path(stage, stage in self.shared_stages)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        artifact = {"stage": stage, "model": self.model, "inputs": inputs_hash, "output": output}
+        # Write to a temp file first, so a crash never leaves a half written checkpoint behind
+        temp_path = path + ".tmp"
+        with Span("save_checkpoint", stage=stage):
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(artifact, f, ensure_ascii=False, indent=4)
+            os.replace(temp_path, path)
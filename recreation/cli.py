@@ -0,0 +1,470 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from recreation import backend
+from recreation.common import EvaluationData, Options, baselines
+
+
+def Run(args) -> None:
+    from loguru import logger
+    from recreation import runner
+    from recreation import ratelimit
+    from recreation.cache import EnableCache, LogStats
+
+    evaluation_data = args.evaluation_data or EvaluationData()
+    if not os.path.exists(evaluation_data):
+        raise Exception(f"Evaluation data not found in {evaluation_data}")
+
+    options = GetOptions(args, result_files=args.sink is None)
+    models = GetModels(args)
+    backend.ConfigureBackend(args.pool_size, args.timeout)
+    persons = args.persons or runner.DiscoverPersons(evaluation_data)
+    jobs = runner.BuildJobs(persons, models, args.baselines)
+    logger.info(f"{len(jobs)} jobs: {len(persons)} persons, {len(models)} models, {len(args.baselines)} baselines")
+    # Like a build system, only the jobs whose inputs, prompts, model or options changed are run again
+    if not args.force:
+        stored = runner.StoredFingerprints(evaluation_data, args.sink)
+        jobs = [job for job in jobs if not runner.UpToDate(job, evaluation_data, options, stored)]
+        logger.info(f"{len(jobs)} jobs to run, the results of the others are up to date")
+
+    limits = GetLimits(args, models)
+
+    if args.dry_run:
+        from recreation.planner import DryRun
+        DryRun(jobs, evaluation_data, options, args.concurrency, limits, args.plan_file)
+        return
+
+    scheduler = ratelimit.ConfigureScheduler(limits, args.concurrency, 4 * args.concurrency, args.max_retries,
+                                             GetHedging(args))
+    StartTracing(args)
+
+    # Responses are cached on disk, so re-running after a post-processing change makes no new calls
+    cache = None if args.no_cache else EnableCache(args.cache_file, args.cache_size << 20)
+    sink = None
+    if args.sink is not None:
+        from recreation.sink import ResultSink
+        sink = ResultSink(args.sink)
+    try:
+        stats = asyncio.run(runner.RunJobs(jobs, evaluation_data, args.concurrency, options, sink=sink))
+    finally:
+        if sink is not None:
+            sink.Close()
+    runner.LogThroughput(stats, jobs)
+    if sink is not None:
+        from recreation.sink import Merge
+        Merge([args.sink], evaluation_data)
+    ratelimit.LogStats(scheduler)
+    if cache is not None:
+        LogStats(cache)
+    if args.context_top_k:
+        from recreation import context
+        context.LogStats()
+    from recreation import validation
+    validation.LogStats()
+    if args.pack_size:
+        from recreation import pack
+        pack.LogStats()
+    WriteTracing(args)
+
+
+def MergeSink(args) -> None:
+    from recreation.sink import Merge
+    Merge(args.sinks, args.evaluation_data or EvaluationData())
+
+
+def Enqueue(args) -> None:
+    from loguru import logger
+    from recreation import runner
+    from recreation.workqueue import WorkQueue
+
+    queue = WorkQueue(args.queue_file)
+    if args.retry_failed:
+        logger.info(f"{queue.Retry()} failed jobs queued again")
+        return
+    evaluation_data = args.evaluation_data or EvaluationData()
+    persons = args.persons or runner.DiscoverPersons(evaluation_data)
+    jobs = runner.BuildJobs(persons, GetModels(args), args.baselines)
+    logger.info(f"{queue.Enqueue(jobs)} of {len(jobs)} jobs queued, the others were already in the queue")
+
+
+# A worker runs the jobs of a shared queue until it is empty, every worker has its own scheduler, cache and sink
+def RunWorker(args) -> None:
+    from loguru import logger
+    from recreation import runner
+    from recreation import ratelimit
+    from recreation.cache import EnableCache, LogStats
+    from recreation.workqueue import LogStatus, WorkQueue, Work, DefaultWorker
+
+    evaluation_data = args.evaluation_data or EvaluationData()
+    queue = WorkQueue(args.queue_file)
+    worker = args.worker or DefaultWorker()
+    options = GetOptions(args, result_files=args.sink is None)
+    if args.models_file:
+        backend.LoadRegistry(args.models_file)
+    backend.ConfigureBackend(args.pool_size, args.timeout)
+    scheduler = ratelimit.ConfigureScheduler(GetLimits(args, queue.Models()), args.concurrency, 4 * args.concurrency,
+                                             args.max_retries, GetHedging(args))
+    StartTracing(args)
+
+    cache = None if args.no_cache else EnableCache(args.cache_file, args.cache_size << 20)
+    sink_file = args.sink.format(worker=worker) if args.sink is not None else None
+    stored = None if args.force else runner.StoredFingerprints(evaluation_data, sink_file)
+    sink = None
+    if sink_file is not None:
+        from recreation.sink import ResultSink
+        sink = ResultSink(sink_file)
+    logger.info(f"Worker {worker} on {args.queue_file}")
+    try:
+        stats = asyncio.run(Work(queue, worker, evaluation_data, args.concurrency, options, sink=sink,
+                                 lease=args.lease, poll_interval=args.poll_interval, stored=stored))
+    finally:
+        if sink is not None:
+            sink.Close()
+    runner.LogThroughput(stats, stats["jobs"])
+    ratelimit.LogStats(scheduler)
+    if cache is not None:
+        LogStats(cache)
+    from recreation import validation
+    validation.LogStats()
+    if args.pack_size:
+        from recreation import pack
+        pack.LogStats()
+    WriteTracing(args)
+    LogStatus(queue.Status(), args.lease)
+
+
+def ShowStatus(args) -> None:
+    from recreation.workqueue import LogStatus, WorkQueue
+    LogStatus(WorkQueue(args.queue_file).Status(), args.lease)
+
+
+def RunBench(args) -> None:
+    from recreation.bench import Bench, LogReport
+
+    StartTracing(args)
+    report = Bench(args.persons, GetModels(args), args.baselines, args.concurrency, args.latency, args.jitter,
+                   args.error_rate, args.rate_limit_rate, args.seed, GetOptions(args, result_files=False),
+                   args.max_retries, args.slow_rate, args.slow_factor, GetHedging(args))
+    LogReport(report)
+    WriteTracing(args)
+    if args.report_file:
+        with open(args.report_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+
+
+# The manifest is refreshed before every query, only the files that changed since the last one are parsed
+def QueryManifest(args) -> None:
+    from recreation.manifest import LogRefresh, Manifest
+
+    manifest = Manifest(args.evaluation_data or EvaluationData(), args.manifest_file)
+    try:
+        if not args.no_refresh or args.action == "refresh":
+            LogRefresh(manifest.Refresh())
+        start = time.perf_counter()
+        if args.action == "missing":
+            rows = [{"person": person, "model": model, "baseline": baseline} for person, model, baseline in
+                    manifest.Missing(GetModels(args), args.baselines or baselines)]
+        elif args.action == "summary":
+            rows = manifest.Summary()
+        elif args.action == "answers":
+            rows = manifest.Answers(args.persons, args.models, args.baselines, args.question)
+        elif args.action == "sql":
+            rows = manifest.Query(args.sql)
+        else:
+            return
+        seconds = time.perf_counter() - start
+    finally:
+        manifest.Close()
+    PrintRows(rows, args.json)
+    from loguru import logger
+    logger.info(f"{len(rows)} rows in {seconds * 1000:.1f}ms")
+
+
+def ExportAnswers(args) -> None:
+    from recreation.export import Export, LogExport
+    LogExport(Export(args.evaluation_data or EvaluationData(), args.export_dir, args.manifest_file, args.force),
+              args.export_dir)
+
+
+# Batch mode: compile writes the requests the jobs are waiting for, ingest reads the result files of the provider and
+# compiles again so every person moves on to its next stage, and simulate answers the open request files offline
+def RunBatch(args) -> None:
+    from loguru import logger
+    from recreation import runner
+    from recreation.batch import BatchStore, Compile, LogCompile, ResultsFile, Simulate
+
+    evaluation_data = args.evaluation_data or EvaluationData()
+    store = BatchStore(args.batch_dir)
+    try:
+        if args.action == "simulate":
+            for requests_file in store.OpenRequestFiles():
+                results_file = ResultsFile(args.batch_dir, requests_file)
+                if not os.path.exists(results_file):
+                    logger.info(f"Answered {Simulate(requests_file, results_file)} requests in {results_file}")
+            return
+        if args.action == "ingest":
+            for results_file in args.results_files or store.NewResultFiles():
+                counts = store.Ingest(results_file)
+                logger.info(f"{results_file}: {counts['answers']} answers, {counts['errors']} errors, "
+                            f"{counts['skipped']} unreadable lines")
+
+        options = GetOptions(args)
+        persons = args.persons or runner.DiscoverPersons(evaluation_data)
+        jobs = runner.BuildJobs(persons, GetModels(args), args.baselines)
+        if not args.force:
+            stored = runner.StoredFingerprints(evaluation_data)
+            jobs = [job for job in jobs if not runner.UpToDate(job, evaluation_data, options, stored)]
+        logger.info(f"{len(jobs)} jobs to compile, the results of the others are up to date")
+        LogCompile(Compile(store, jobs, evaluation_data, options))
+    finally:
+        store.Close()
+
+
+# Rows are printed tab separated with a header, or as JSON lines
+def PrintRows(rows: list, as_json: bool = False) -> None:
+    if as_json:
+        for row in rows:
+            print(json.dumps(row, ensure_ascii=False))
+        return
+    if not rows:
+        return
+    print("\t".join(rows[0]))
+    for row in rows:
+        print("\t".join("" if value is None else str(value).replace("\n", " ") for value in row.values()))
+
+
+# Spans are only recorded when a trace or metrics file is asked for
+def StartTracing(args) -> None:
+    if args.trace_file or args.metrics_file:
+        from recreation import tracing
+        tracing.Enable()
+
+
+def WriteTracing(args) -> None:
+    from loguru import logger
+    from recreation import tracing
+    if args.trace_file:
+        tracing.WriteChromeTrace(args.trace_file)
+        logger.info(f"Wrote {len(tracing.spans)} spans to {args.trace_file}")
+    if args.metrics_file:
+        tracing.WriteOpenMetrics(args.metrics_file)
+        logger.info(f"Wrote the span metrics to {args.metrics_file}")
+
+
+def AddTracingArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--trace-file", help="Write a span per chain call and I/O step to this Chrome trace file, it "
+                                             "opens in chrome://tracing or ui.perfetto.dev")
+    parser.add_argument("--metrics-file", help="Write the latency histograms of the spans to this OpenMetrics file")
+
+
+# The options of the baselines are shared by the commands that run them
+def AddOptionArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--share-stages", action="store_true",
+                        help="Reuse the RoleGPT description and QA checkpoints of a person for every model")
+    parser.add_argument("--prefix-stable", action="store_true",
+                        help="Put the prompt text shared by every person first and warm it before the other jobs")
+    parser.add_argument("--fan-out", action="store_true",
+                        help="Ask the RPP questions one per call, concurrently, after a single stage 1 call")
+    parser.add_argument("--conversation", action="store_true",
+                        help="Ask the Juliet questions as the turns of one session, with a bounded context window")
+    parser.add_argument("--pack-size", type=int,
+                        help="Answer the Juliet questions and RPP stage 1 of up to this many persons per call, keep "
+                             "--concurrency above it so the packs fill")
+    parser.add_argument("--context-top-k", type=int,
+                        help="Only put the top k background snippets relevant to the questions in the prompts")
+
+
+def AddHedgingArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--hedge-percentile", type=float,
+                        help="Send a call again when it is slower than this percentile of the recent calls of its "
+                             "model and stage, e.g. 95, the first response wins. Off by default")
+    parser.add_argument("--hedge-budget", type=float, default=0.05,
+                        help="Most hedged calls as a share of the calls of a model, default 0.05")
+
+
+def GetHedging(args):
+    if args.hedge_percentile is None:
+        return None
+    from recreation.ratelimit import HedgePolicy
+    return HedgePolicy(args.hedge_percentile, args.hedge_budget)
+
+
+# Quotas of the models: the defaults of ratelimit, then the ones of the registry, then --rpm and --tpm
+def GetLimits(args, models: list) -> dict:
+    from recreation import ratelimit
+    limits = {model: dict(ratelimit.default_limits.get(model, {})) for model in models}
+    for model in models:
+        spec = backend.GetSpec(model)
+        for key, value in [("rpm", args.rpm or spec.rpm), ("tpm", args.tpm or spec.tpm)]:
+            if value:
+                limits[model][key] = value
+    return limits
+
+
+# The models of the registry, plus the ones of --models-file, the default ones are run when --models is not given
+def GetModels(args) -> list:
+    if args.models_file:
+        backend.LoadRegistry(args.models_file)
+    return args.models or backend.DefaultModels()
+
+
+def GetOptions(args, result_files: bool = True) -> Options:
+    return Options(share_stages=args.share_stages, result_files=result_files, context_top_k=args.context_top_k,
+                   fan_out=args.fan_out, prefix_stable=args.prefix_stable, conversation=args.conversation,
+                   pack_size=args.pack_size)
+
+
+def BuildParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m recreation", description="Run the ECHO baselines")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="Run every person, model and baseline concurrently")
+    run.add_argument("--evaluation-data", help="Default is evaluation/evaluation_data of the current directory")
+    run.add_argument("--persons", nargs="*", help="Only run these persons, default is every person folder")
+    run.add_argument("--models", nargs="+", help="Default is every default model of the registry")
+    run.add_argument("--models-file", help="JSON list of models to add to the registry, e.g. local endpoints: "
+                                          '[{"model": "llama", "base_url": "http://localhost:8000/v1", "default": true}]')
+    run.add_argument("--pool-size", type=int, help="Connections of the HTTP client shared by every model, default 64")
+    run.add_argument("--timeout", type=float, help="Seconds before an API request times out, default 60")
+    run.add_argument("--baselines", nargs="+", default=baselines, choices=baselines)
+    run.add_argument("--concurrency", type=int, default=16)
+    run.add_argument("--cache-file", help="Default is .cache/llm_cache.sqlite of the current directory")
+    run.add_argument("--cache-size", type=int, default=1024, help="Size limit of the LLM cache in MiB")
+    run.add_argument("--no-cache", action="store_true")
+    run.add_argument("--dry-run", action="store_true",
+                     help="Render every prompt offline and estimate the tokens, cost and wall time of the run")
+    run.add_argument("--rpm", type=int, help="Requests per minute quota of each model, default depends on the model")
+    run.add_argument("--tpm", type=int, help="Tokens per minute quota of each model, default depends on the model")
+    run.add_argument("--max-retries", type=int, default=6, help="Retries of a call on 429 and transient errors")
+    run.add_argument("--plan-file", help="Write the estimate of every call of the dry run to this JSON file")
+    run.add_argument("--force", action="store_true", help="Run every job, also the ones whose result is up to date")
+    run.add_argument("--sink", help="Append the results to this JSONL file instead of one file per result, and "
+                                     "merge them into the final result file of every person at the end")
+    AddOptionArguments(run)
+    AddHedgingArguments(run)
+    AddTracingArguments(run)
+    run.set_defaults(func=Run)
+
+    merge = subparsers.add_parser("merge", help="Write the final result files of every person from a JSONL sink")
+    merge.add_argument("sinks", nargs="+", help="JSONL sinks, e.g. the sinks of every worker of a queue")
+    merge.add_argument("--evaluation-data", help="Default is evaluation/evaluation_data of the current directory")
+    merge.set_defaults(func=MergeSink)
+
+    bench = subparsers.add_parser("bench", help="Measure the throughput and overhead of the pipeline offline, "
+                                                "against fake models over a synthetic corpus")
+    bench.add_argument("--persons", type=int, default=20, help="Number of synthetic persons")
+    bench.add_argument("--models", nargs="+", help="Default is every default model of the registry")
+    bench.add_argument("--models-file", help="JSON list of models to add to the registry")
+    bench.add_argument("--baselines", nargs="+", default=baselines, choices=baselines)
+    bench.add_argument("--concurrency", type=int, default=16)
+    bench.add_argument("--latency", type=float, default=0.5, help="Seconds a fake call takes")
+    bench.add_argument("--jitter", type=float, default=0.2, help="Seconds a fake call takes more or less")
+    bench.add_argument("--error-rate", type=float, default=0.0, help="Share of the calls that fail with a 5xx")
+    bench.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of the calls that fail with a 429")
+    bench.add_argument("--slow-rate", type=float, default=0.0, help="Share of the calls that are slow")
+    bench.add_argument("--slow-factor", type=float, default=5.0, help="Times the latency a slow call takes")
+    bench.add_argument("--max-retries", type=int, default=6)
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--report-file", help="Write the report to this JSON file")
+    AddOptionArguments(bench)
+    AddHedgingArguments(bench)
+    AddTracingArguments(bench)
+    bench.set_defaults(func=RunBench)
+
+    enqueue = subparsers.add_parser("enqueue", help="Add the jobs of a sweep to a work queue shared by workers")
+    enqueue.add_argument("queue_file", help="SQLite file of the queue, on a file system every worker can see")
+    enqueue.add_argument("--evaluation-data", help="Default is evaluation/evaluation_data of the current directory")
+    enqueue.add_argument("--persons", nargs="*", help="Only queue these persons, default is every person folder")
+    enqueue.add_argument("--models", nargs="+", help="Default is every default model of the registry")
+    enqueue.add_argument("--models-file", help="JSON list of models to add to the registry")
+    enqueue.add_argument("--baselines", nargs="+", default=baselines, choices=baselines)
+    enqueue.add_argument("--retry-failed", action="store_true", help="Queue the failed jobs again instead")
+    enqueue.set_defaults(func=Enqueue)
+
+    worker = subparsers.add_parser("worker", help="Run the jobs of a work queue until none is left, start one per "
+                                                  "machine or more")
+    worker.add_argument("queue_file")
+    worker.add_argument("--worker", help="Name of the worker, default is <host>-<pid>")
+    worker.add_argument("--evaluation-data", help="Default is evaluation/evaluation_data of the current directory")
+    worker.add_argument("--models-file", help="JSON list of models to add to the registry, the same as the sweep's")
+    worker.add_argument("--pool-size", type=int, help="Connections of the HTTP client shared by every model, "
+                                                      "default 64")
+    worker.add_argument("--timeout", type=float, help="Seconds before an API request times out, default 60")
+    worker.add_argument("--concurrency", type=int, default=16)
+    worker.add_argument("--lease", type=float, default=600.0,
+                        help="Seconds a claimed job stays with a worker that stopped sending heartbeats")
+    worker.add_argument("--poll-interval", type=float, default=10.0,
+                        help="Seconds between looks at the queue when no job is pending")
+    worker.add_argument("--cache-file", help="Default is .cache/llm_cache.sqlite of the current directory, keep it "
+                                             "on a local disk")
+    worker.add_argument("--cache-size", type=int, default=1024, help="Size limit of the LLM cache in MiB")
+    worker.add_argument("--no-cache", action="store_true")
+    worker.add_argument("--rpm", type=int, help="Requests per minute quota of each model for this worker, the "
+                                                "workers share the quota of the account")
+    worker.add_argument("--tpm", type=int, help="Tokens per minute quota of each model for this worker")
+    worker.add_argument("--max-retries", type=int, default=6, help="Retries of a call on 429 and transient errors")
+    worker.add_argument("--force", action="store_true", help="Run every job, also the ones whose result is up to date")
+    worker.add_argument("--sink", help="Append the results to this JSONL file, {worker} is replaced by the name of "
+                                       "the worker so each has its own, merge them with the merge command")
+    AddOptionArguments(worker)
+    AddHedgingArguments(worker)
+    AddTracingArguments(worker)
+    worker.set_defaults(func=RunWorker)
+
+    status = subparsers.add_parser("status", help="Show the progress of a work queue and the throughput per worker")
+    status.add_argument("queue_file")
+    status.add_argument("--lease", type=float, default=600.0, help="Lease of the workers, to tell the lost ones")
+    status.set_defaults(func=ShowStatus)
+
+    manifest = subparsers.add_parser("manifest", help="Index the evaluation data in SQLite and query the corpus")
+    manifest.add_argument("action", choices=["refresh", "missing", "summary", "answers", "sql"],
+                          help="refresh the index, list the missing results, count the results and answers of every "
+                               "baseline and model, list answers, or run SQL on the tables")
+    manifest.add_argument("sql", nargs="?", help="Query of the sql action, e.g. \"SELECT person, COUNT(*) FROM "
+                                                  "latest_answers GROUP BY person\"")
+    manifest.add_argument("--evaluation-data", help="Default is evaluation/evaluation_data of the current directory")
+    manifest.add_argument("--manifest-file", help="Default is .manifest.sqlite in the evaluation data")
+    manifest.add_argument("--no-refresh", action="store_true", help="Query the index as it is")
+    manifest.add_argument("--persons", nargs="+")
+    manifest.add_argument("--models", nargs="+", help="Default of missing is every default model of the registry")
+    manifest.add_argument("--models-file", help="JSON list of models to add to the registry")
+    manifest.add_argument("--baselines", nargs="+", choices=baselines)
+    manifest.add_argument("--question", help="Only the answers to questions that contain this text")
+    manifest.add_argument("--json", action="store_true", help="Print the rows as JSON lines")
+    manifest.set_defaults(func=QueryManifest)
+
+    export = subparsers.add_parser("export", help="Export every answer to a Parquet dataset partitioned by baseline "
+                                                  "and model, needs pyarrow")
+    export.add_argument("export_dir")
+    export.add_argument("--evaluation-data", help="Default is evaluation/evaluation_data of the current directory")
+    export.add_argument("--manifest-file", help="Default is .manifest.sqlite in the evaluation data")
+    export.add_argument("--force", action="store_true", help="Write every partition, also the up to date ones")
+    export.set_defaults(func=ExportAnswers)
+
+    batch = subparsers.add_parser("batch", help="Run the sweep offline through the batch API of the provider, one "
+                                                "stage of every person per round of request files")
+    batch.add_argument("action", choices=["compile", "ingest", "simulate"],
+                       help="write the pending requests, read result files and compile the next stage, or answer "
+                            "the open request files with a fake model")
+    batch.add_argument("results_files", nargs="*", help="Result files of ingest, default is the new files in "
+                                                        "<batch dir>/results")
+    batch.add_argument("--batch-dir", default="batch", help="Folder of the request and result files, default batch")
+    batch.add_argument("--evaluation-data", help="Default is evaluation/evaluation_data of the current directory")
+    batch.add_argument("--persons", nargs="*", help="Only compile these persons, default is every person folder")
+    batch.add_argument("--models", nargs="+", help="Default is every default model of the registry")
+    batch.add_argument("--models-file", help="JSON list of models to add to the registry")
+    batch.add_argument("--baselines", nargs="+", default=baselines, choices=baselines)
+    batch.add_argument("--force", action="store_true", help="Compile every job, also the ones whose result is up to "
+                                                            "date")
+    AddOptionArguments(batch)
+    batch.set_defaults(func=RunBatch)
+
+    return parser
+
+
+def main(argv: list = None) -> None:
+    args = BuildParser().parse_args(argv)
+    args.func(args)
@@ -0,0 +1,244 @@
+from dataclasses import dataclass
+import contextvars
+import functools
+import json
+import os
+import time
+
+# The baselines are scheduled in this order, so the longest chains (RoleGPT has three stages) start first
+# and the last batch of jobs is made of the short ones
+baselines = ["RoleGPT", "RPP", "Juliet"]
+
+
+# Options of a run that change how the baselines work, every field defaults to the original behaviour
+@dataclass
+class Options:
+    # Reuse the RoleGPT description and QA checkpoints of a person for every model
+    share_stages: bool = False
+    # Write the result of each job to its own <model>_<baseline>_QA.json, off when the results go to a sink
+    result_files: bool = True
+    # Only inline the top k background snippets that are relevant to the evaluation questions, None inlines it all
+    context_top_k: int = None
+    # Ask the RPP questions one per call, concurrently and on top of a single stage 1 response
+    fan_out: bool = False
+    # Lay the prompts out with the text shared by every person first, and warm that prefix before the other jobs
+    prefix_stable: bool = False
+    # Ask the Juliet questions as the turns of one session, with a sliding window and a summary of the older turns
+    conversation: bool = False
+    # Answer the Juliet questions and the RPP stage 1 of up to this many persons in one call, None sends one per person
+    pack_size: int = None
+
+
+# Raised by a model whose answer is not available yet, e.g. a request waiting in a batch. The job stops there and
+# runs again, from its checkpoints, once the answer is in
+class Deferred(Exception):
+    pass
+
+
+# The evaluation data is resolved when it is needed, importing the baselines never touches the file system
+def EvaluationData(parent_dir: str = None) -> str:
+    return os.path.join(parent_dir or os.getcwd(), "evaluation", "evaluation_data")
+
+
+@functools.lru_cache(maxsize=None)
+def LoadEnv() -> None:
+    from dotenv import load_dotenv, find_dotenv
+    _ = load_dotenv(find_dotenv(usecwd=True))  # read local .env file
+
+
+# The clients are created on first use and shared by every person of the process, see backend for the models
+@functools.lru_cache(maxsize=None)
+def GetLLM(model: str):
+    from recreation.backend import ChatModel
+    LoadEnv()
+    return ChatModel(model)
+
+
+# The (person, model, baseline) job and the name of the stage whose chain is being called, so the models and
+# tools that see every call can tell them apart
+current_job = contextvars.ContextVar("current_job", default=None)
+current_stage = contextvars.ContextVar("current_stage", default=None)
+# The inputs of the person whose jobs are running, so every job of the person reads and parses its files once.
+# Outside of a person (e.g. PromptModel) the files are read on every use
+person_inputs = contextvars.ContextVar("person_inputs", default=None)
+# Calls and seconds spent in ACall by every stage of the process, waits for the quota and retries included
+stage_times = {}
+
+
+# Every chain of the baselines is called through here, it returns the outputs of the chain. The call waits for
+# its turn in the quota of the model and transient errors are retried. valid(outputs) tells a hedged call which
+# answer can win its race
+async def ACall(chain, inputs: dict, stage: str, valid=None) -> dict:
+    from recreation import tracing
+    from recreation.ratelimit import EstimateTokens, GetScheduler
+
+    token = current_stage.set(stage)
+    start = time.perf_counter()
+    try:
+        model = getattr(chain.llm, "model_name", None)
+        tokens = EstimateTokens(chain, inputs)
+        with tracing.Span(stage, "llm", estimated_tokens=tokens, retries=0, hedges=0):
+            return await GetScheduler().Run(model, tokens, lambda: chain.acall(inputs), stage, valid)
+    finally:
+        current_stage.reset(token)
+        times = stage_times.setdefault(stage, [0, 0.0])
+        times[0] += 1
+        times[1] += time.perf_counter() - start
+
+
+# tiktoken is optional, without it (or without its encoding files) a token is counted as 4 characters
+@functools.lru_cache(maxsize=None)
+def Encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        try:
+            return tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            return None
+
+
+def CountTokens(text: str, model: str = "gpt-4") -> int:
+    encoding = Encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+# Method of loading an input of the person once, the loaded inputs are shared by its jobs and must not be changed
+def Loaded(key: tuple, load):
+    inputs = person_inputs.get()
+    if inputs is None:
+        return load()
+    if key not in inputs:
+        inputs[key] = load()
+    return inputs[key]
+
+
+# Method of loading the background information of the person, assume it has "Name" field
+def LoadData(data_file: str):
+    from recreation.tracing import Span
+
+    def load():
+        with Span("load_data"), open(data_file, 'r') as f:
+            data = json.load(f)
+            person_name = data["Name"]
+        return data, person_name
+    return Loaded(("data", data_file), load)
+
+
+# Method of loading the background that goes into the prompts, pruned to the snippets relevant to the questions
+# when the options ask for it
+def LoadContext(data_file: str, questions: list, options: Options = None):
+    data, person_name = LoadData(data_file)
+    if options is not None and options.context_top_k:
+        from recreation.context import SelectContext
+        data = Loaded(("context", data_file, tuple(questions), options.context_top_k),
+                      lambda: SelectContext(data, questions, options.context_top_k, os.path.dirname(data_file)))
+    return data, person_name
+
+
+# Method of loading the questions from the question file
+def LoadQuestions(question_file: str):
+    from recreation.tracing import Span
+
+    def load():
+        with Span("load_questions"), open(question_file, 'r') as f:
+            json_data = json.load(f)
+            questions = [pair["question"] for pair in json_data["qa_pairs"]]
+            questions_string = "\n".join(questions)
+        return questions, questions_string
+    return Loaded(("questions", question_file), load)
+
+
+def DataFile(evaluation_folder: str) -> str:
+    return os.path.join(evaluation_folder, "background_info.json")
+
+
+def QuestionFile(evaluation_folder: str) -> str:
+    return os.path.join(evaluation_folder, "evaluation_questions.json")
+
+
+# The temp result file of each model, the final result file will be the combination of them
+def ResultFile(evaluation_folder: str, model: str, result_suffix: str) -> str:
+    return os.path.join(evaluation_folder, model + result_suffix)
+
+
+# Method of building the JSON schema of the structured output, a list of exactly 10 question and answer pairs
+def QASchema(title: str, name: str = None, answer_key: str = "answer", items: int = 10) -> dict:
+    json_schema = {
+        "title": title,
+        "type": "object",
+        "properties": {
+            "qa_pairs": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "question": {
+                            "type": "string"
+                        },
+                        answer_key: {
+                            "type": "string"
+                        }
+                    },
+                    "required": ["question", answer_key]
+                },
+                "minItems": items,
+                "maxItems": items
+            }
+        },
+        "required": ["qa_pairs"]
+    }
+    if name is not None:
+        json_schema = {"name": name, **json_schema}
+    return json_schema
+
+
+def HashFile(path: str) -> str:
+    import hashlib
+
+    def load():
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+    return Loaded(("hash", path), load)
+
+
+# The templates are built once per process, so each one is serialized and hashed once
+template_hashes = {}
+
+
+def HashTemplates(templates: dict) -> dict:
+    import hashlib
+    from langchain.load.dump import dumps
+    for template in templates.values():
+        if id(template) not in template_hashes:
+            template_hashes[id(template)] = hashlib.sha256(dumps(template).encode("utf-8")).hexdigest()
+    return {name: template_hashes[id(template)] for name, template in templates.items()}
+
+
+# Method of fingerprinting the result of a job, like a build system does. It covers the background and questions of
+# the person, the prompt templates and output schemas of the baseline, the model, and the options that change what
+# is sent. A result made with the same fingerprint is up to date and the job is skipped. Options left at their
+# default are not part of it, so a new option does not make every result out of date
+def ResultFingerprint(evaluation_folder: str, model: str, options: Options, templates: dict, schemas: list) -> str:
+    import hashlib
+    from dataclasses import asdict
+    defaults = asdict(Options())
+    parts = {
+        "background_info": HashFile(DataFile(evaluation_folder)),
+        "evaluation_questions": HashFile(QuestionFile(evaluation_folder)),
+        "templates": HashTemplates(templates),
+        "schemas": schemas,
+        "model": model,
+        "options": {key: value for key, value in asdict(options or Options()).items()
+                    if key != "result_files" and value != defaults[key]},
+    }
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
@@ -0,0 +1,151 @@
+from loguru import logger
+import hashlib
+import json
+import math
+import os
+import re
+
+from recreation.common import CountTokens
+
+# The index of a person is cached next to its data and rebuilt when the background changes
+index_file_name = os.path.join(".cache", "context_index.json")
+# Fields that are always kept, whatever the questions are
+always_keep = {"Name"}
+# Long text fields are split into chunks of about this many words, so a single field can be partly kept
+chunk_words = 60
+stop_words = {"a", "an", "and", "are", "as", "at", "be", "by", "did", "do", "does", "for", "from", "had", "has",
+              "have", "how", "i", "in", "is", "it", "of", "on", "or", "that", "the", "to", "was", "were", "what",
+              "when", "where", "which", "who", "why", "will", "with", "would", "you", "your"}
+# Token savings of every selection of the process
+stats = {"selections": 0, "full_tokens": 0, "selected_tokens": 0}
+
+
+def Tokenize(text: str) -> list:
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in stop_words]
+
+
+# Method of splitting the background into snippets, each one is the path of a leaf value and a piece of its text.
+# Nested fields are named by their keys and list positions, e.g. ["Career", 0]
+def Snippets(data, path: list = None) -> list:
+    path = path or []
+    if isinstance(data, dict):
+        return [snippet for key, value in data.items() for snippet in Snippets(value, path + [key])]
+    if isinstance(data, list):
+        return [snippet for i, value in enumerate(data) for snippet in Snippets(value, path + [i])]
+    words = str(data).split()
+    chunks = [" ".join(words[i:i + chunk_words]) for i in range(0, len(words), chunk_words)] or [str(data)]
+    return [{"path": path, "chunk": i, "text": chunk} for i, chunk in enumerate(chunks)]
+
+
+# A BM25 index over the snippets of one person, the field names are indexed together with the text
+class SnippetIndex:
+    def __init__(self, snippets: list, k1: float = 1.5, b: float = 0.75):
+        self.snippets = snippets
+        self.k1 = k1
+        self.b = b
+        self.terms = []
+        document_frequency = {}
+        for snippet in snippets:
+            counts = {}
+            for word in Tokenize(" ".join(str(key) for key in snippet["path"]) + " " + snippet["text"]):
+                counts[word] = counts.get(word, 0) + 1
+            self.terms.append(counts)
+            for word in counts:
+                document_frequency[word] = document_frequency.get(word, 0) + 1
+        n = max(len(snippets), 1)
+        self.idf = {word: math.log(1 + (n - df + 0.5) / (df + 0.5)) for word, df in document_frequency.items()}
+        self.lengths = [sum(counts.values()) for counts in self.terms]
+        self.average_length = sum(self.lengths) / n or 1.0
+
+    def Scores(self, query: str) -> list:
+        words = set(Tokenize(query))
+        scores = []
+        for counts, length in zip(self.terms, self.lengths):
+            score = 0.0
+            for word in words & counts.keys():
+                tf = counts[word]
+                score += self.idf[word] * tf * (self.k1 + 1) / \
+                    (tf + self.k1 * (1 - self.b + self.b * length / self.average_length))
+            scores.append(score)
+        return scores
+
+    def ToDict(self) -> dict:
+        return {"snippets": self.snippets, "terms": self.terms, "idf": self.idf, "lengths": self.lengths,
+                "average_length": self.average_length}
+
+    @classmethod
+    def FromDict(cls, saved: dict) -> "SnippetIndex":
+        index = cls.__new__(cls)
+        index.k1, index.b = 1.5, 0.75
+        for key, value in saved.items():
+            setattr(index, key, value)
+        return index
+
+
+def LoadIndex(data: dict, evaluation_folder: str) -> SnippetIndex:
+    data_hash = hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    index_file = os.path.join(evaluation_folder, index_file_name)
+    try:
+        with open(index_file, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved["data_hash"] == data_hash:
+            return SnippetIndex.FromDict(saved["index"])
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    index = SnippetIndex(Snippets(data))
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    with open(index_file + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump({"data_hash": data_hash, "index": index.ToDict()}, f, ensure_ascii=False)
+    os.replace(index_file + ".tmp", index_file)
+    return index
+
+
+# Method of rebuilding the background from the kept snippets, in the original order and structure
+def Rebuild(data, snippets: list, path: list = None):
+    path = path or []
+    if isinstance(data, dict):
+        kept = {key: Rebuild(value, snippets, path + [key]) for key, value in data.items()}
+        return {key: value for key, value in kept.items() if value is not None}
+    if isinstance(data, list):
+        kept = [Rebuild(value, snippets, path + [i]) for i, value in enumerate(data)]
+        kept = [value for value in kept if value is not None]
+        return kept or None
+    chunks = [snippet for snippet in snippets if snippet["path"] == path]
+    if not chunks:
+        return None
+    if len(chunks) == len(Snippets(data)):
+        return data
+    return " ... ".join(snippet["text"] for snippet in sorted(chunks, key=lambda snippet: snippet["chunk"]))
+
+
+# Method of keeping only the top_k snippets of the background that are the most relevant to the questions. Each
+# snippet scores its best match over the questions, so every question brings its own facts into the context
+def SelectContext(data: dict, questions: list, top_k: int, evaluation_folder: str) -> dict:
+    index = LoadIndex(data, evaluation_folder)
+    scores = [0.0] * len(index.snippets)
+    for question in questions:
+        scores = [max(old, new) for old, new in zip(scores, index.Scores(question))]
+
+    ranked = sorted(range(len(index.snippets)), key=lambda i: -scores[i])
+    keep = set(i for i in ranked[:top_k] if scores[i] > 0)
+    keep |= {i for i, snippet in enumerate(index.snippets) if snippet["path"][:1] and snippet["path"][0] in always_keep}
+    selected = Rebuild(data, [index.snippets[i] for i in sorted(keep)]) or {}
+
+    full_tokens = CountTokens(str(data))
+    selected_tokens = CountTokens(str(selected))
+    stats["selections"] += 1
+    stats["full_tokens"] += full_tokens
+    stats["selected_tokens"] += selected_tokens
+    logger.info(f"{data.get('Name')}: kept {len(keep)} of {len(index.snippets)} background snippets, "
+                f"{full_tokens} -> {selected_tokens} tokens per call")
+    return selected
+
+
+def LogStats() -> None:
+    if stats["selections"]:
+        full_tokens = stats["full_tokens"] / stats["selections"]
+        selected_tokens = stats["selected_tokens"] / stats["selections"]
+        logger.info(f"Context selection: {stats['selections']} selections, the background of a call went from "
+                    f"{full_tokens:.0f} to {selected_tokens:.0f} tokens on average "
+                    f"({1 - selected_tokens / max(full_tokens, 1):.0%} saved)")
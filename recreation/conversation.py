@@ -0,0 +1,51 @@
+# The context of a multi turn session: the static system prefix, a rolling summary of the older turns, and a sliding
+# window of the recent turns. Every summary_every turns the oldest turns of the window are folded into the summary,
+# so a turn never sends more than window_turns + summary_every - 1 turns and the summary, however long the session
+window_turns = 4
+summary_every = 4
+# Length the summary is asked to stay under
+summary_words = 150
+
+
+class ConversationWindow:
+    def __init__(self, state: dict = None, window_turns: int = window_turns, summary_every: int = summary_every):
+        state = state or {}
+        self.window_turns = window_turns
+        self.summary_every = summary_every
+        self.turns = [tuple(turn) for turn in state.get("turns", [])]
+        self.summary = state.get("summary", "")
+        # Number of the first turns that are in the summary
+        self.summarized = state.get("summarized", 0)
+
+    def Add(self, question: str, answer: str) -> None:
+        self.turns.append((question, answer))
+
+    def Recent(self) -> list:
+        return self.turns[self.summarized:]
+
+    # The turns to fold into the summary before the next turn, none until the window is full
+    def Due(self) -> list:
+        recent = self.Recent()
+        if len(recent) < self.window_turns + self.summary_every:
+            return []
+        return recent[:len(recent) - self.window_turns]
+
+    def Folded(self, summary: str, turns: int) -> None:
+        self.summary = summary
+        self.summarized += turns
+
+    # The inputs of the turn prompt: the summary as a system message once there is one, and the recent turns
+    def Inputs(self) -> dict:
+        from langchain.schema import AIMessage, HumanMessage, SystemMessage
+        history = []
+        for question, answer in self.Recent():
+            history += [HumanMessage(content=question), AIMessage(content=answer)]
+        summary = [SystemMessage(content=f"What was said earlier in this chat: {self.summary}")] if self.summary else []
+        return {"summary": summary, "history": history}
+
+    def State(self) -> dict:
+        return {"turns": [list(turn) for turn in self.turns], "summary": self.summary, "summarized": self.summarized}
+
+
+def FormatTurns(turns: list) -> str:
+    return "\n".join(f"Interrogator: {question}\nYou: {answer}" for question, answer in turns)
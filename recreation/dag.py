@@ -0,0 +1,59 @@
+import asyncio
+
+
+class DependencyFailed(Exception):
+    pass
+
+
+# A small dependency graph of async stages. A stage starts as soon as the stages it depends on are done, so the
+# stages without a dependency between them run concurrently and the wall time is the one of the critical path. A
+# stage gets the results of its dependencies, and the stages that depend on a failed one fail with DependencyFailed
+class Graph:
+    def __init__(self):
+        self.stages = {}
+
+    def Add(self, name, run, dependencies: list = ()) -> None:
+        if name in self.stages:
+            raise ValueError(f"Stage {name} is already in the graph")
+        self.stages[name] = (run, list(dependencies))
+
+    # Method of ordering the stages so that every stage comes after its dependencies
+    def Order(self) -> list:
+        order, state = [], {}
+
+        def visit(name, path: list):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"Cycle in the graph: {' -> '.join(map(str, path + [name]))}")
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name}, a dependency of {path[-1]}")
+            state[name] = "visiting"
+            for dependency in self.stages[name][1]:
+                visit(dependency, path + [name])
+            state[name] = "done"
+            order.append(name)
+
+        for name in self.stages:
+            visit(name, [])
+        return order
+
+    # Method of running every stage, it returns the result of each one, or the exception it failed with
+    async def Run(self) -> dict:
+        tasks = {}
+
+        async def run(name):
+            run_stage, dependencies = self.stages[name]
+            results = {}
+            for dependency in dependencies:
+                try:
+                    results[dependency] = await tasks[dependency]
+                except Exception as e:
+                    raise DependencyFailed(f"{name}: {dependency} failed with {e!r}") from e
+            return await run_stage(results)
+
+        # The tasks are all created before any of them runs, a dependency always has its task when it is awaited
+        for name in self.Order():
+            tasks[name] = asyncio.ensure_future(run(name))
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        return dict(zip(tasks, results))
@@ -0,0 +1,121 @@
+from loguru import logger
+import hashlib
+import json
+import os
+import shutil
+import time
+import urllib.parse
+
+from recreation.manifest import Manifest
+
+# The answers of every result as a Parquet dataset, one folder per baseline and model in the hive layout
+# (baseline=RPP/model=gpt-4-1106-preview/answers.parquet), so the analysis reads it with
+# pyarrow.parquet.read_table(export_dir, filters=[("baseline", "=", "RPP")]) and gets the baseline and model columns
+# from the folder names. The answers are read from the manifest in batches and written a row group at a time, and
+# a partition is only written again when one of its results changed since the last export
+state_file_name = "_export_state.json"
+batch_rows = 65536
+
+
+def Schema():
+    import pyarrow as pa
+    return pa.schema([
+        ("persona", pa.string()),
+        ("question_index", pa.int32()),
+        ("question", pa.string()),
+        ("answer", pa.string()),
+        ("fingerprint", pa.string()),
+    ])
+
+
+def PartitionFolder(export_dir: str, baseline: str, model: str) -> str:
+    return os.path.join(export_dir, f"baseline={urllib.parse.quote(baseline, safe='')}",
+                        f"model={urllib.parse.quote(model, safe='')}")
+
+
+# The version of a partition, it changes when a result of the partition is added, removed or written again
+def PartitionVersion(manifest: Manifest, baseline: str, model: str) -> str:
+    digest = hashlib.sha256()
+    for row in manifest.conn.execute("SELECT person, path, mtime_ns, fingerprint FROM latest_results "
+                                     "WHERE baseline = ? AND model = ? ORDER BY person", (baseline, model)):
+        digest.update(repr(row).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def WritePartition(manifest: Manifest, export_dir: str, baseline: str, model: str) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = Schema()
+    folder = PartitionFolder(export_dir, baseline, model)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, "answers.parquet")
+    # Written to a temp file first, a reader never sees half a partition
+    temp_path = path + ".tmp"
+    rows = 0
+    cursor = manifest.conn.execute(
+        "SELECT a.person, a.position, a.question, a.answer, r.fingerprint FROM latest_answers a "
+        "JOIN results r ON r.path = a.path AND r.model = a.model "
+        "WHERE a.baseline = ? AND a.model = ? ORDER BY a.person, a.position", (baseline, model))
+    with pq.ParquetWriter(temp_path, schema, compression="zstd", use_dictionary=["persona", "fingerprint"]) as writer:
+        while True:
+            batch = cursor.fetchmany(batch_rows)
+            if not batch:
+                break
+            columns = list(zip(*batch))
+            writer.write_table(pa.Table.from_arrays([pa.array(column, type=field.type)
+                                                     for column, field in zip(columns, schema)], schema=schema))
+            rows += len(batch)
+    os.replace(temp_path, path)
+    return rows
+
+
+# Method of exporting the answers of the evaluation data to a Parquet dataset, the manifest is refreshed first
+def Export(evaluation_data: str, export_dir: str, manifest_file: str = None, force: bool = False) -> dict:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise Exception("The Parquet export needs pyarrow, install it with pip install pyarrow")
+
+    start = time.perf_counter()
+    os.makedirs(export_dir, exist_ok=True)
+    state_file = os.path.join(export_dir, state_file_name)
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        state = {}
+
+    manifest = Manifest(evaluation_data, manifest_file)
+    stats = {"partitions": 0, "written": 0, "removed": 0, "rows": 0}
+    try:
+        manifest.Refresh()
+        partitions = manifest.conn.execute("SELECT DISTINCT baseline, model FROM latest_results "
+                                           "ORDER BY baseline, model").fetchall()
+        new_state = {}
+        for baseline, model in partitions:
+            key = f"{baseline}/{model}"
+            new_state[key] = PartitionVersion(manifest, baseline, model)
+            stats["partitions"] += 1
+            if not force and state.get(key) == new_state[key]:
+                continue
+            stats["rows"] += WritePartition(manifest, export_dir, baseline, model)
+            stats["written"] += 1
+    finally:
+        manifest.Close()
+
+    for key in state.keys() - new_state.keys():
+        baseline, model = key.split("/", 1)
+        shutil.rmtree(PartitionFolder(export_dir, baseline, model), ignore_errors=True)
+        stats["removed"] += 1
+    temp_file = state_file + ".tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(new_state, f, indent=4)
+    os.replace(temp_file, state_file)
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def LogExport(stats: dict, export_dir: str) -> None:
+    logger.info(f"Exported {stats['rows']} answers to {export_dir} in {stats['seconds']:.2f}s: {stats['written']} of "
+                f"{stats['partitions']} partitions written, the others were up to date, {stats['removed']} removed")
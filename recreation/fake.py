@@ -0,0 +1,104 @@
+from typing import Any, List, Optional
+import asyncio
+import hashlib
+import json
+import random
+
+from langchain.chat_models.base import BaseChatModel
+from langchain.pydantic_v1 import Field
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult
+
+from recreation.common import current_job, current_stage
+
+# Errors with the names and status codes of the openai client errors, so the scheduler retries them the same way
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class InternalServerError(Exception):
+    status_code = 500
+
+
+words = ["well", "i", "guess", "that", "was", "back", "when", "we", "lived", "near", "the", "old", "harbour",
+         "and", "my", "family", "spent", "most", "weekends", "together"]
+
+
+# A chat model that never leaves the process. It answers with deterministic text of a configurable length, and
+# with a schema valid function call when the chain passes functions, and records every call it gets
+class FakeChatModel(BaseChatModel):
+    model_name: str = "fake"
+    # Tokens of a plain text answer, and of each string field of a function call by field name
+    text_tokens: int = 150
+    field_tokens: dict = Field(default_factory=lambda: {"question": 25, "answer": 60, "response": 80})
+    default_field_tokens: int = 40
+    # Out of the repr, langchain serializes the model on every call and the list grows with the run
+    calls: list = Field(default_factory=list, repr=False)
+    # Never read or write the LLM cache, every call reaches the model
+    cache: Optional[bool] = False
+    # Seconds an async call takes, give or take the jitter, and the share of the calls that fail with a 5xx error
+    # or a 429. The random draws are seeded, so a benchmark sees the same latencies and errors on every run
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    # Share of the calls that take slow_factor times the latency, the tail of a real endpoint
+    slow_rate: float = 0.0
+    slow_factor: float = 5.0
+    seed: int = 0
+    rng: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "echo-fake"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"model_name": self.model_name}
+
+    def Text(self, tokens: int, seed: int) -> str:
+        return " ".join(words[(seed + i) % len(words)] for i in range(tokens))
+
+    def Fill(self, schema: dict, seed: int, key: str = None):
+        if schema.get("type") == "object":
+            return {name: self.Fill(value, seed + i, name)
+                    for i, (name, value) in enumerate(schema.get("properties", {}).items())}
+        if schema.get("type") == "array":
+            return [self.Fill(schema["items"], seed + i, key) for i in range(schema.get("minItems", 1))]
+        return self.Text(self.field_tokens.get(key, self.default_field_tokens), seed)
+
+    def Respond(self, messages: List[BaseMessage], functions: list = None, function_call=None, latency: float = 0.0,
+                **kwargs: Any) -> ChatResult:
+        seed = int(hashlib.sha256("".join(m.content for m in messages).encode("utf-8")).hexdigest()[:8], 16)
+        if functions:
+            function = functions[0]
+            arguments = json.dumps(self.Fill(function["parameters"], seed))
+            message = AIMessage(content="", additional_kwargs={
+                "function_call": {"name": function["name"], "arguments": arguments}})
+            output = arguments
+        else:
+            output = self.Text(self.text_tokens, seed)
+            message = AIMessage(content=output)
+        self.calls.append({"job": current_job.get(), "stage": current_stage.get(), "model": self.model_name,
+                           "messages": messages, "functions": functions, "output": output, "latency": latency})
+        return ChatResult(generations=[ChatGeneration(message=message)],
+                          llm_output={"model_name": self.model_name})
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                  **kwargs: Any) -> ChatResult:
+        return self.Respond(messages, **kwargs)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                         **kwargs: Any) -> ChatResult:
+        if self.rng is None:
+            self.rng = random.Random(f"{self.seed}/{self.model_name}")
+        latency = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+        draw = self.rng.random()
+        if self.slow_rate and self.rng.random() < self.slow_rate:
+            latency *= self.slow_factor
+        if latency > 0:
+            await asyncio.sleep(latency)
+        if draw < self.rate_limit_rate:
+            raise RateLimitError(f"{self.model_name}: rate limit reached")
+        if draw < self.rate_limit_rate + self.error_rate:
+            raise InternalServerError(f"{self.model_name}: server error")
+        return self.Respond(messages, latency=latency, **kwargs)
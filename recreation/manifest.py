@@ -0,0 +1,194 @@
+from loguru import logger
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from recreation.common import baselines
+from recreation.runner import GetBaseline
+
+# An index of the evaluation data in one SQLite file: the persons, their questions, and the result files of every
+# model and baseline with their answers. A file is parsed again only when its mtime or size changed, so a refresh of
+# an unchanged corpus is a stat per file, and the corpus wide questions are SQL queries
+manifest_file_name = ".manifest.sqlite"
+
+schema = [
+    "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, person TEXT NOT NULL, kind TEXT NOT NULL, "
+    "mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, hash TEXT NOT NULL, error TEXT)",
+    "CREATE TABLE IF NOT EXISTS backgrounds (path TEXT PRIMARY KEY, person TEXT NOT NULL, name TEXT)",
+    "CREATE TABLE IF NOT EXISTS questions (path TEXT NOT NULL, person TEXT NOT NULL, position INTEGER NOT NULL, "
+    "question TEXT, PRIMARY KEY (path, position))",
+    "CREATE TABLE IF NOT EXISTS results (path TEXT NOT NULL, model TEXT NOT NULL, person TEXT NOT NULL, "
+    "baseline TEXT NOT NULL, fingerprint TEXT, pairs INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+    "PRIMARY KEY (path, model))",
+    "CREATE TABLE IF NOT EXISTS answers (path TEXT NOT NULL, model TEXT NOT NULL, person TEXT NOT NULL, "
+    "baseline TEXT NOT NULL, position INTEGER NOT NULL, question TEXT, answer TEXT, "
+    "PRIMARY KEY (path, model, position))",
+    "CREATE INDEX IF NOT EXISTS questions_person ON questions (person)",
+    "CREATE INDEX IF NOT EXISTS results_job ON results (baseline, model, person)",
+    "CREATE INDEX IF NOT EXISTS answers_job ON answers (baseline, model, person)",
+    # A result can be both in the file of its model and in the final file of the baseline, the newer one counts
+    "CREATE VIEW IF NOT EXISTS latest_results AS SELECT * FROM results r WHERE NOT EXISTS (SELECT 1 FROM results o "
+    "WHERE o.baseline = r.baseline AND o.model = r.model AND o.person = r.person AND "
+    "(o.mtime_ns > r.mtime_ns OR (o.mtime_ns = r.mtime_ns AND o.path > r.path)))",
+    "CREATE VIEW IF NOT EXISTS latest_answers AS SELECT a.* FROM answers a JOIN latest_results r "
+    "ON a.path = r.path AND a.model = r.model",
+    "CREATE VIEW IF NOT EXISTS persons AS SELECT person, MAX(name) AS name FROM backgrounds GROUP BY person",
+]
+
+
+def DefaultManifestFile(evaluation_data: str) -> str:
+    return os.path.join(evaluation_data, manifest_file_name)
+
+
+# The kind and baseline of a file of a person folder, None for the files that are not indexed
+def Kind(file_name: str):
+    if file_name == "background_info.json":
+        return "background", None
+    if file_name == "evaluation_questions.json":
+        return "questions", None
+    for name in baselines:
+        module = GetBaseline(name)
+        if file_name == module.final_result_name:
+            return "final", name
+        if file_name.endswith(module.result_suffix):
+            return "result", name
+    return None
+
+
+def Pairs(result: dict) -> list:
+    answers = result.get("Answers") if isinstance(result, dict) else None
+    pairs = answers.get("qa_pairs") if isinstance(answers, dict) else None
+    return [pair for pair in pairs if isinstance(pair, dict)] if isinstance(pairs, list) else []
+
+
+class Manifest:
+    def __init__(self, evaluation_data: str, manifest_file: str = None):
+        self.evaluation_data = evaluation_data
+        self.manifest_file = manifest_file or DefaultManifestFile(evaluation_data)
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_file)), exist_ok=True)
+        self.conn = sqlite3.connect(self.manifest_file, isolation_level=None)
+        for statement in schema:
+            self.conn.execute(statement)
+
+    def Close(self) -> None:
+        self.conn.close()
+
+    # Method of bringing the manifest up to date: new and changed files are parsed, the rows of removed files dropped
+    def Refresh(self) -> dict:
+        start = time.perf_counter()
+        known = {path: (mtime_ns, size) for path, mtime_ns, size in
+                 self.conn.execute("SELECT path, mtime_ns, size FROM files")}
+        seen, changed = set(), []
+        for person_entry in os.scandir(self.evaluation_data):
+            if not person_entry.is_dir() or person_entry.name.startswith("."):
+                continue
+            for entry in os.scandir(person_entry.path):
+                kind = Kind(entry.name) if entry.is_file() else None
+                if kind is None:
+                    continue
+                path = person_entry.name + "/" + entry.name
+                stat = entry.stat()
+                seen.add(path)
+                if known.get(path) != (stat.st_mtime_ns, stat.st_size):
+                    changed.append((path, person_entry.name, *kind, stat))
+        removed = [path for path in known if path not in seen]
+
+        self.conn.execute("BEGIN")
+        try:
+            for path in removed + [path for path, *_ in changed]:
+                for table in ["files", "backgrounds", "questions", "results", "answers"]:
+                    self.conn.execute(f"DELETE FROM {table} WHERE path = ?", (path,))
+            for path, person, kind, baseline, stat in changed:
+                self.Index(path, person, kind, baseline, stat)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        new = sum(1 for path, *_ in changed if path not in known)
+        return {"files": len(seen), "new": new, "changed": len(changed) - new, "removed": len(removed),
+                "seconds": time.perf_counter() - start}
+
+    def Index(self, path: str, person: str, kind: str, baseline: str, stat) -> None:
+        with open(os.path.join(self.evaluation_data, path), 'rb') as f:
+            content = f.read()
+        error = None
+        try:
+            data = json.loads(content)
+        except ValueError as e:
+            data, error = None, repr(e)
+        self.conn.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (path, person, kind, stat.st_mtime_ns, stat.st_size, hashlib.sha256(content).hexdigest(),
+                           error))
+        if data is None:
+            return
+
+        if kind == "background":
+            self.conn.execute("INSERT INTO backgrounds VALUES (?, ?, ?)",
+                              (path, person, data.get("Name") if isinstance(data, dict) else None))
+        elif kind == "questions":
+            pairs = data.get("qa_pairs") if isinstance(data, dict) else None
+            self.conn.executemany("INSERT INTO questions VALUES (?, ?, ?, ?)",
+                                  [(path, person, i, pair.get("question")) for i, pair in enumerate(pairs or [])
+                                   if isinstance(pair, dict)])
+        else:
+            # A final file holds the results of every model, the file of a model only its own
+            for result in (data if kind == "final" and isinstance(data, list) else [data]):
+                if not isinstance(result, dict) or "model" not in result:
+                    continue
+                pairs = Pairs(result)
+                self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  (path, result["model"], person, baseline, result.get("fingerprint"), len(pairs),
+                                   stat.st_mtime_ns))
+                self.conn.executemany("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      [(path, result["model"], person, baseline, i, pair.get("question"),
+                                        pair.get("answer", pair.get("response"))) for i, pair in enumerate(pairs)])
+
+    # The persons without a result with answers for each of the models and baselines, none without a model or baseline
+    def Missing(self, models: list, baseline_names: list) -> list:
+        wanted = [(model, baseline) for baseline in baseline_names for model in models]
+        if not wanted:
+            return []
+        values = ", ".join(["(?, ?)"] * len(wanted))
+        return self.conn.execute(
+            f"WITH wanted (model, baseline) AS (VALUES {values}) "
+            "SELECT p.person, w.model, w.baseline FROM persons p CROSS JOIN wanted w "
+            "WHERE EXISTS (SELECT 1 FROM questions q WHERE q.person = p.person) AND NOT EXISTS "
+            "(SELECT 1 FROM latest_results r WHERE r.person = p.person AND r.model = w.model "
+            "AND r.baseline = w.baseline AND r.pairs > 0) ORDER BY w.baseline, w.model, p.person",
+            [value for pair in wanted for value in pair]).fetchall()
+
+    # Results, answers and answer lengths of every baseline and model
+    def Summary(self) -> list:
+        return self.Query(
+            "SELECT r.baseline, r.model, COUNT(DISTINCT r.person) AS persons, COUNT(a.position) AS answers, "
+            "SUM(COALESCE(TRIM(a.answer), '') = '') AS empty_answers, "
+            "ROUND(AVG(LENGTH(a.answer)), 1) AS mean_answer_chars "
+            "FROM latest_results r LEFT JOIN answers a ON a.path = r.path AND a.model = r.model "
+            "GROUP BY r.baseline, r.model ORDER BY r.baseline, r.model")
+
+    def Answers(self, persons: list = None, models: list = None, baseline_names: list = None,
+                question: str = None) -> list:
+        conditions, arguments = [], []
+        for column, values in [("person", persons), ("model", models), ("baseline", baseline_names)]:
+            if values:
+                conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+                arguments += values
+        if question:
+            conditions.append("question LIKE ?")
+            arguments.append(f"%{question}%")
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        return self.Query(f"SELECT person, model, baseline, position, question, answer FROM latest_answers {where}"
+                          "ORDER BY person, baseline, model, position", arguments)
+
+    # Method of running any SQL on the manifest, the rows come back as dicts
+    def Query(self, sql: str, arguments: list = ()) -> list:
+        cursor = self.conn.execute(sql, arguments)
+        columns = [column[0] for column in cursor.description or []]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def LogRefresh(refresh: dict) -> None:
+    logger.info(f"Manifest refreshed in {refresh['seconds'] * 1000:.0f}ms: {refresh['files']} files, "
+                f"{refresh['new']} new, {refresh['changed']} changed, {refresh['removed']} removed")
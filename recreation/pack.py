@@ -0,0 +1,122 @@
+from loguru import logger
+import asyncio
+
+from recreation.common import current_job
+
+# Packing of the short requests of several persons into one structured call. The jobs of a stage and model hand their
+# request to the packer of the stage and wait for their own answer. A pack is sent when it is full or when no other
+# person joined it for `linger` seconds, so the static instructions are sent once per pack instead of once per person
+linger = 0.2
+# Packs, persons, splits and single calls of each stage of the process
+stats = {}
+# The packer of every (stage, model), for the event loop that made it
+packers = {}
+
+
+def PersonKey(i: int) -> str:
+    return f"person_{i + 1}"
+
+
+# The schema of a packed answer: an object with the schema of each person under its key
+def PackSchema(title: str, sections: list) -> dict:
+    return {
+        "title": title,
+        "type": "object",
+        "properties": {PersonKey(i): section for i, section in enumerate(sections)},
+        "required": [PersonKey(i) for i in range(len(sections))],
+    }
+
+
+def Count(stage: str, key: str, amount: int = 1) -> None:
+    stage_stats = stats.setdefault(stage, {"packs": 0, "persons": 0, "splits": 0, "single_calls": 0})
+    stage_stats[key] += amount
+
+
+# Method of answering the items of a pack. call(items) makes one packed call and returns the answer of each item, None
+# for the ones whose section failed validation. The failed items are split in two and packed again, and an item left
+# alone goes to single(item), the call of one person. The error of a single call is the answer of its item only
+async def AnswerPacked(stage: str, items: list, call, single) -> list:
+    if len(items) == 1:
+        Count(stage, "single_calls")
+        try:
+            return [await single(items[0])]
+        except Exception as e:
+            return [e]
+    Count(stage, "packs")
+    Count(stage, "persons", len(items))
+    answers = await call(items)
+    failed = [i for i, answer in enumerate(answers) if answer is None]
+    if failed:
+        Count(stage, "splits")
+        logger.warning(f"{stage}: {len(failed)} of {len(items)} persons of the pack failed validation, "
+                       f"asking them again in smaller packs")
+        retry = [items[i] for i in failed]
+        halves = [half for half in [retry[:len(retry) // 2], retry[len(retry) // 2:]] if half]
+        retried = [answer for half in await asyncio.gather(*(AnswerPacked(stage, half, call, single)
+                                                             for half in halves)) for answer in half]
+        for i, answer in zip(failed, retried):
+            answers[i] = answer
+    return answers
+
+
+class Packer:
+    def __init__(self, stage: str, size: int, call, single):
+        self.stage = stage
+        self.size = size
+        self.call = call
+        self.single = single
+        self.loop = asyncio.get_running_loop()
+        self.pending = []
+        self.timer = None
+
+    # Method of adding the request of a person to the next pack, it returns the answer of that person
+    async def Ask(self, item):
+        future = self.loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.size:
+            self.Flush()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(linger, self.Flush)
+        return await future
+
+    def Flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pack, self.pending = self.pending, []
+        if pack:
+            asyncio.ensure_future(self.Send(pack))
+
+    async def Send(self, pack: list) -> None:
+        # The calls of the pack are made for several jobs, they go to a pack of the model and baseline instead of
+        # the job that filled it
+        job = current_job.get()
+        if job is not None:
+            current_job.set((f"pack of {len(pack)}", job[1], job[2]))
+        try:
+            answers = await AnswerPacked(self.stage, [item for item, _ in pack], self.call, self.single)
+        except Exception as e:
+            answers = [e] * len(pack)
+        for (_, future), answer in zip(pack, answers):
+            if future.done():
+                continue
+            if isinstance(answer, Exception):
+                future.set_exception(answer)
+            else:
+                future.set_result(answer)
+
+
+# The packer of a stage and model. call and single are those of the first job that asks, every job of the stage and
+# model makes the same calls
+def GetPacker(stage: str, model: str, size: int, call, single) -> Packer:
+    packer = packers.get((stage, model))
+    if packer is None or packer.loop is not asyncio.get_running_loop() or packer.size != size:
+        packer = packers[(stage, model)] = Packer(stage, size, call, single)
+    return packer
+
+
+def LogStats() -> None:
+    for stage, stage_stats in sorted(stats.items()):
+        logger.info(f"{stage}: {stage_stats['persons']} persons in {stage_stats['packs']} packed calls, "
+                    f"{stage_stats['splits']} packs split after a failed validation, "
+                    f"{stage_stats['single_calls']} single calls")
@@ -0,0 +1,147 @@
+from loguru import logger
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+
+from recreation.common import CountTokens, DataFile, Options, QuestionFile
+from recreation.fake import FakeChatModel
+from recreation.prefix import PrefixCache, RequestTokens
+from recreation.runner import RunJobs
+
+# USD per 1K input and output tokens
+prices = {
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+    "gpt-4-1106-preview": (0.01, 0.03),
+}
+# Seconds before the first token and output tokens per second of a call
+speeds = {
+    "gpt-3.5-turbo-1106": (0.5, 60.0),
+    "gpt-4-1106-preview": (1.0, 20.0),
+}
+default_speed = (1.0, 30.0)
+
+
+# Tokens of a chat request: every message costs its content plus 3 tokens, the reply is primed with 3 more, and
+# the function definitions are counted as their JSON
+def CountRequestTokens(messages: list, functions: list, model: str) -> int:
+    tokens = 3 + sum(3 + CountTokens(message.content, model) for message in messages)
+    if functions:
+        tokens += CountTokens(json.dumps(functions), model)
+    return tokens
+
+
+# Method of rendering every prompt of the jobs without any network call. The jobs run for real on a copy of the
+# person inputs, against fake models that answer with outputs of the expected size and record each request
+async def Plan(jobs: list, evaluation_data: str, options: Options = None) -> list:
+    fake_llm = {}
+
+    def get_llm(model: str) -> FakeChatModel:
+        return fake_llm.setdefault(model, FakeChatModel(model_name=model))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for person in {job[0] for job in jobs}:
+            os.makedirs(os.path.join(temp_dir, person))
+            for file in [DataFile, QuestionFile]:
+                shutil.copy(file(os.path.join(evaluation_data, person)), file(os.path.join(temp_dir, person)))
+        await RunJobs(jobs, temp_dir, max(len(jobs), 1), options, get_llm)
+
+    # The calls are replayed in the order they were made against a stand-in of the provider prompt cache
+    prefix_cache = PrefixCache()
+    records = []
+    for llm in fake_llm.values():
+        for call in llm.calls:
+            person, model, baseline = call["job"]
+            records.append({
+                "person": person,
+                "model": model,
+                "baseline": baseline,
+                "stage": call["stage"],
+                "input_tokens": CountRequestTokens(call["messages"], call["functions"], model),
+                "prefix_tokens": prefix_cache.Request(model, RequestTokens(call["messages"], call["functions"], model)),
+                "output_tokens": CountTokens(call["output"], model),
+            })
+    return records
+
+
+def Cost(model: str, input_tokens: int, output_tokens: int) -> float:
+    input_price, output_price = prices.get(model, (0.0, 0.0))
+    return input_tokens / 1000 * input_price + output_tokens / 1000 * output_price
+
+
+def Latency(model: str, output_tokens: int) -> float:
+    first_token, tokens_per_second = speeds.get(model, default_speed)
+    return first_token + output_tokens / tokens_per_second
+
+
+# Method of adding up the records per stage, per person and in total, and estimating the wall time. The stages of a
+# job run one after another, the jobs run `concurrency` at a time, and each model has its own rpm and tpm quota
+def Summarize(records: list, concurrency: int, limits: dict = None) -> dict:
+    def add(totals: dict, key, record: dict) -> None:
+        total = totals.setdefault(key, {"calls": 0, "input_tokens": 0, "prefix_tokens": 0, "output_tokens": 0,
+                                        "cost": 0.0})
+        total["calls"] += 1
+        total["input_tokens"] += record["input_tokens"]
+        total["prefix_tokens"] += record["prefix_tokens"]
+        total["output_tokens"] += record["output_tokens"]
+        total["cost"] += Cost(record["model"], record["input_tokens"], record["output_tokens"])
+
+    stages, batches, persons, models, jobs, total = {}, {}, {}, {}, {}, {}
+    for record in records:
+        add(stages, f"{record['baseline']}/{record['stage']}", record)
+        add(batches, f"{record['baseline']}/{record['model']}", record)
+        add(persons, record["person"], record)
+        add(models, record["model"], record)
+        add(total, "total", record)
+        job = (record["person"], record["model"], record["baseline"])
+        jobs[job] = jobs.get(job, 0.0) + Latency(record["model"], record["output_tokens"])
+
+    wall_time = {"concurrency": max(max(jobs.values(), default=0.0), sum(jobs.values()) / max(concurrency, 1))}
+    for model, model_total in models.items():
+        model_limits = (limits or {}).get(model, {})
+        if model_limits.get("rpm"):
+            wall_time[f"{model} rpm"] = model_total["calls"] / model_limits["rpm"] * 60
+        if model_limits.get("tpm"):
+            wall_time[f"{model} tpm"] = \
+                (model_total["input_tokens"] + model_total["output_tokens"]) / model_limits["tpm"] * 60
+
+    return {
+        "stages": stages,
+        "batches": batches,
+        "persons": persons,
+        "models": models,
+        "total": total.get("total", {"calls": 0, "input_tokens": 0, "prefix_tokens": 0, "output_tokens": 0,
+                                     "cost": 0.0}),
+        "wall_time": max(wall_time.values()),
+        "bottleneck": max(wall_time, key=wall_time.get),
+    }
+
+
+def LogPlan(summary: dict) -> None:
+    def line(name: str, total: dict) -> str:
+        return (f"{name}: {total['calls']} calls, {total['input_tokens']} input tokens "
+                f"({total['prefix_tokens']} in a shared prefix), {total['output_tokens']} output tokens, "
+                f"${total['cost']:.2f}")
+
+    for name, total in sorted(summary["stages"].items()):
+        logger.info(line(name, total))
+    for name, total in sorted(summary["batches"].items()):
+        logger.info(line(name, total))
+    for name, total in sorted(summary["persons"].items()):
+        logger.info(line(name, total))
+    for name, total in sorted(summary["models"].items()):
+        logger.info(line(name, total))
+    logger.info(line("Total", summary["total"]))
+    logger.info(f"Expected wall time: {summary['wall_time'] / 60:.1f} min, bound by {summary['bottleneck']}")
+
+
+def DryRun(jobs: list, evaluation_data: str, options: Options, concurrency: int, limits: dict = None,
+           plan_file: str = None) -> dict:
+    records = asyncio.run(Plan(jobs, evaluation_data, options))
+    summary = Summarize(records, concurrency, limits)
+    LogPlan(summary)
+    if plan_file:
+        with open(plan_file, 'w', encoding='utf-8') as f:
+            json.dump({"summary": summary, "calls": records}, f, indent=4)
+    return summary
@@ -0,0 +1,39 @@
+import hashlib
+import json
+
+from recreation.common import Encoding
+
+# Like the provider prompt cache, a shared prefix grows by blocks of tokens. Providers only cache a prefix from
+# about 1024 tokens on, the minimum is 0 so every shared prefix is counted, set it to match the provider
+min_cached_tokens = 0
+block_tokens = 128
+
+
+# Method of turning a chat request into the tokens the provider sees, the function definitions come first
+def RequestTokens(messages: list, functions: list, model: str) -> list:
+    text = json.dumps(functions) if functions else ""
+    text += "".join(f"<{message.type}>{message.content}" for message in messages)
+    encoding = Encoding(model)
+    if encoding is None:
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+    return encoding.encode(text, disallowed_special=())
+
+
+# A local stand-in for the prompt cache of the provider. Each request is cut into blocks, and the hash of every
+# prefix of whole blocks is remembered per model, so a request is cached as far as its longest prefix seen before
+class PrefixCache:
+    def __init__(self):
+        self.prefixes = {}
+
+    def Request(self, model: str, tokens: list) -> int:
+        prefixes = self.prefixes.setdefault(model, set())
+        digest = hashlib.sha256()
+        cached, matching = 0, True
+        for end in range(block_tokens, len(tokens) + 1, block_tokens):
+            digest.update(repr(tokens[end - block_tokens:end]).encode("utf-8"))
+            key = digest.hexdigest()
+            matching = matching and key in prefixes
+            if matching:
+                cached = end
+            prefixes.add(key)
+        return cached if cached >= min_cached_tokens else 0
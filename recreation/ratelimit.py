@@ -0,0 +1,302 @@
+from collections import deque
+from loguru import logger
+import asyncio
+import json
+import random
+import time
+
+from recreation import tracing
+
+# Requests and tokens per minute of each model, they depend on the tier of the account so adjust them with
+# --rpm/--tpm. Models that are not listed are only limited by the adaptive concurrency
+default_limits = {
+    "gpt-3.5-turbo-1106": {"rpm": 3500, "tpm": 160000},
+    "gpt-4-1106-preview": {"rpm": 500, "tpm": 150000},
+}
+# Expected output tokens of a call, counted against the tokens per minute before the call is sent
+expected_output_tokens = {"text": 250, "function": 1000}
+
+# Names of the exceptions of the openai client (both the 0.x and the 1.x versions) that are worth retrying
+retryable_errors = {"RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError", "APIError",
+                    "ServiceUnavailableError", "Timeout", "TryAgain"}
+
+
+def StatusCode(e: Exception):
+    return getattr(e, "status_code", None) or getattr(e, "http_status", None)
+
+
+def IsRateLimit(e: Exception) -> bool:
+    return type(e).__name__ == "RateLimitError" or StatusCode(e) == 429
+
+
+def IsRetryable(e: Exception) -> bool:
+    if IsRateLimit(e) or type(e).__name__ in retryable_errors:
+        return True
+    status_code = StatusCode(e)
+    return isinstance(status_code, int) and status_code >= 500
+
+
+# Seconds the server asked us to wait in the Retry-After header, if any
+def RetryAfter(e: Exception):
+    headers = getattr(getattr(e, "response", None), "headers", None) or getattr(e, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+# Rough token count of a chain call: the rendered prompt and functions as 4 characters per token, plus the output
+def EstimateTokens(chain, inputs: dict) -> int:
+    try:
+        prompts, _ = chain.prep_prompts([inputs])
+        characters = sum(len(message.content) for message in prompts[0].to_messages())
+    except Exception:
+        characters = sum(len(str(value)) for value in inputs.values())
+    functions = getattr(chain, "llm_kwargs", {}).get("functions")
+    if functions:
+        characters += len(json.dumps(functions))
+    return characters // 4 + expected_output_tokens["function" if functions else "text"]
+
+
+# A token bucket that refills continuously. A caller reserves what it needs and sleeps for the returned time, the
+# balance can go negative so the callers are served in order without a lock
+class TokenBucket:
+    def __init__(self, per_minute: float, burst_seconds: float = 10.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate * burst_seconds, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def Reserve(self, amount: float) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+    # After a 429 nothing is sent until the bucket refills
+    def Drain(self, seconds: float = 0.0) -> None:
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+# The limits of one model. The concurrency grows by one per window of successful calls, and shrinks by half on a
+# 429 or by a tenth when the latency of a stage drifts far above the best one seen for that stage. The latencies
+# are kept per stage, a long structured call is never compared with a short text one
+class ModelLimiter:
+    def __init__(self, model: str, rpm: int = None, tpm: int = None, concurrency: int = 4, max_concurrency: int = 64):
+        self.model = model
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.limit = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.latency = {}
+        self.best_latency = {}
+        self.loop = None
+        self.condition = None
+        self.stats = {"calls": 0, "retries": 0, "rate_limited": 0, "failed": 0, "hedges": 0, "hedges_won": 0,
+                      "hedges_wasted": 0}
+
+    # The limiter may outlive an event loop (every PromptModel call runs its own), the condition follows the loop
+    def Condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.condition = asyncio.Condition()
+            self.in_flight = 0
+        return self.condition
+
+    async def Wait(self, tokens: int) -> None:
+        delay = 0.0
+        if self.requests is not None:
+            delay = max(delay, self.requests.Reserve(1))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.Reserve(tokens))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def Acquire(self) -> None:
+        condition = self.Condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < max(int(self.limit), 1))
+            self.in_flight += 1
+
+    async def Release(self) -> None:
+        condition = self.Condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    def OnSuccess(self, latency: float, stage: str = None) -> None:
+        average = self.latency.get(stage)
+        average = latency if average is None else 0.8 * average + 0.2 * latency
+        self.latency[stage] = average
+        self.best_latency[stage] = min(self.best_latency.get(stage, average), average)
+        if average > 2 * self.best_latency[stage]:
+            self.limit = max(1.0, self.limit * 0.9)
+        else:
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+
+    def OnRateLimit(self, retry_after: float = None) -> None:
+        self.stats["rate_limited"] += 1
+        self.limit = max(1.0, self.limit / 2)
+        for bucket in [self.requests, self.tokens]:
+            if bucket is not None:
+                bucket.Drain(retry_after or 0.0)
+
+
+# Hedging of the slow calls: a call that takes longer than the percentile of the recent latencies of its model and
+# stage is sent a second time, the first response wins and the other request is cancelled. The latencies are kept
+# per stage, so the long structured calls are only compared with each other, and the hedges of a model are capped
+# at a share of its calls, so the spend grows by that share at most
+class HedgePolicy:
+    def __init__(self, percentile: float = 95.0, budget: float = 0.05, min_samples: int = 20, window: int = 200):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.window = window
+        self.latencies = {}
+
+    def Record(self, key: tuple, latency: float) -> None:
+        self.latencies.setdefault(key, deque(maxlen=self.window)).append(latency)
+
+    # Seconds a call waits before it is hedged, None until the stage has enough latencies to tell a slow call
+    def Delay(self, key: tuple):
+        latencies = self.latencies.get(key)
+        if latencies is None or len(latencies) < self.min_samples:
+            return None
+        latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1, int(self.percentile / 100 * len(latencies)))]
+
+    def Allowed(self, stats: dict) -> bool:
+        return stats["hedges"] < self.budget * stats["calls"]
+
+
+# The process wide scheduler every chain call goes through. It retries transient errors with jittered exponential
+# backoff, and once configured it also keeps each model within its quota and adapts its concurrency
+class Scheduler:
+    def __init__(self, limits: dict = None, concurrency: int = None, max_concurrency: int = 64, max_retries: int = 6,
+                 base_delay: float = 1.0, max_delay: float = 60.0, hedging: HedgePolicy = None):
+        self.limits = limits or {}
+        self.hedging = hedging
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiters = {}
+
+    def Limiter(self, model: str) -> ModelLimiter:
+        if model not in self.limiters:
+            limits = self.limits.get(model, {})
+            self.limiters[model] = ModelLimiter(model, limits.get("rpm"), limits.get("tpm"), self.concurrency or 1,
+                                                self.max_concurrency)
+        return self.limiters[model]
+
+    def Backoff(self, attempt: int, retry_after: float = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    # Method of making one attempt of a call, with a hedge when the call is slow and the budget allows it. With
+    # valid(result), an answer that is not valid (e.g. a function call cut short) does not win the race, the other
+    # request keeps running as it may still give a valid one
+    async def Attempt(self, limiter: ModelLimiter, stage: str, tokens: int, call, valid=None):
+        delay = self.hedging.Delay((limiter.model, stage)) if self.hedging is not None else None
+        if delay is None:
+            return await call()
+
+        async def hedge():
+            # The hedge is a request of its own for the quota, it takes no concurrency slot as the budget bounds it
+            await limiter.Wait(tokens)
+            return await call()
+
+        tasks = [asyncio.ensure_future(call())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self.hedging.Allowed(limiter.stats):
+                return await tasks[0]
+            limiter.stats["hedges"] += 1
+            tracing.Annotate(hedges=1)
+            tasks.append(asyncio.ensure_future(hedge()))
+            pending = set(tasks)
+            invalid = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # The first request wins a tie
+                for task in [task for task in tasks if task in done]:
+                    if task.exception() is not None:
+                        continue
+                    if valid is not None and not valid(task.result()):
+                        invalid = invalid or task
+                        continue
+                    limiter.stats["hedges_won" if task is tasks[1] else "hedges_wasted"] += 1
+                    return task.result()
+            limiter.stats["hedges_wasted"] += 1
+            # No valid answer, the first answer that came back goes to the repairs of the caller
+            if invalid is not None:
+                return invalid.result()
+            # Both failed, the error of the first one goes to the retries
+            raise tasks[0].exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def Run(self, model: str, tokens: int, call, stage: str = None, valid=None):
+        limiter = self.Limiter(model)
+        attempt = 0
+        while True:
+            await limiter.Wait(tokens)
+            # Without a configured concurrency the calls are only bounded by the jobs that make them
+            if self.concurrency:
+                await limiter.Acquire()
+            start = time.monotonic()
+            try:
+                limiter.stats["calls"] += 1
+                result = await self.Attempt(limiter, stage, tokens, call, valid)
+            except Exception as e:
+                if not IsRetryable(e) or attempt >= self.max_retries:
+                    limiter.stats["failed"] += 1
+                    raise
+                retry_after = RetryAfter(e)
+                if IsRateLimit(e):
+                    limiter.OnRateLimit(retry_after)
+                delay = self.Backoff(attempt, retry_after)
+                limiter.stats["retries"] += 1
+                tracing.Annotate(retries=1)
+                logger.warning(f"{model} call failed with {type(e).__name__}, retry {attempt + 1} in {delay:.1f}s")
+            else:
+                limiter.OnSuccess(time.monotonic() - start, stage)
+                if self.hedging is not None:
+                    self.hedging.Record((model, stage), time.monotonic() - start)
+                return result
+            finally:
+                if self.concurrency:
+                    await limiter.Release()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+scheduler = Scheduler()
+
+
+def GetScheduler() -> Scheduler:
+    return scheduler
+
+
+# Method of setting the quota of every model for the rest of the process
+def ConfigureScheduler(limits: dict = None, concurrency: int = 16, max_concurrency: int = 64,
+                       max_retries: int = 6, hedging: HedgePolicy = None) -> Scheduler:
+    global scheduler
+    scheduler = Scheduler(default_limits if limits is None else limits, concurrency, max_concurrency, max_retries,
+                          hedging=hedging)
+    return scheduler
+
+
+def LogStats(scheduler: Scheduler) -> None:
+    for model, limiter in scheduler.limiters.items():
+        stats = limiter.stats
+        logger.info(f"{model}: {stats['calls']} calls, {stats['retries']} retries, {stats['rate_limited']} rate "
+                    f"limited, {stats['failed']} failed, concurrency settled at {int(limiter.limit)}")
+        if stats["hedges"]:
+            logger.info(f"{model}: {stats['hedges']} hedged calls, the hedge won {stats['hedges_won']} and "
+                        f"{stats['hedges_wasted']} were wasted")
@@ -0,0 +1,197 @@
+from loguru import logger
+import asyncio
+import heapq
+import importlib
+import json
+import os
+import time
+
+from recreation.common import DataFile, Deferred, GetLLM, HashFile, LoadData, LoadQuestions, Options, QuestionFile, \
+    ResultFile, current_job, person_inputs
+from recreation.dag import DependencyFailed, Graph
+from recreation.tracing import Span
+
+
+# The baselines are imported when a job needs them
+def GetBaseline(baseline: str):
+    return importlib.import_module("recreation." + baseline)
+
+
+# Method of finding every person folder, a folder is a person only if it has both the background and questions
+def DiscoverPersons(evaluation_data: str) -> list:
+    persons = []
+    for entry in sorted(os.scandir(evaluation_data), key=lambda e: e.name):
+        if not entry.is_dir():
+            continue
+        if os.path.exists(os.path.join(entry.path, "background_info.json")) and \
+                os.path.exists(os.path.join(entry.path, "evaluation_questions.json")):
+            persons.append(entry.name)
+    return persons
+
+
+# Every job is a (person, model, baseline) triple
+def BuildJobs(persons: list, models: list, baseline_names: list) -> list:
+    return [(person, model, baseline) for baseline in baseline_names for model in models for person in persons]
+
+
+# Method of finding the fingerprint of the result a job made before, from the JSONL sink when the results go to
+# one, else from the result file of the job
+def StoredFingerprints(evaluation_data: str, sink_file: str = None):
+    if sink_file is not None:
+        from recreation.sink import ReadSink
+        fingerprints = {}
+        if os.path.exists(sink_file):
+            for record in ReadSink(sink_file):
+                fingerprints[(record["person"], record["result"]["model"], record["baseline"])] = \
+                    record["result"].get("fingerprint")
+        return fingerprints.get
+
+    def stored(job: tuple):
+        person, model, baseline = job
+        result_file = ResultFile(os.path.join(evaluation_data, person), model, GetBaseline(baseline).result_suffix)
+        try:
+            with open(result_file, 'r', encoding='utf-8') as f:
+                return json.load(f).get("fingerprint")
+        except (FileNotFoundError, json.JSONDecodeError, AttributeError):
+            return None
+    return stored
+
+
+# A job is up to date when its result was made from the same inputs, templates, schemas, model and options
+def UpToDate(job: tuple, evaluation_data: str, options: Options, stored) -> bool:
+    person, model, baseline = job
+    fingerprint = stored(job)
+    return fingerprint is not None and \
+        fingerprint == GetBaseline(baseline).Fingerprint(os.path.join(evaluation_data, person), model, options)
+
+
+# Method of running one job, its latency goes to the stats. It returns the error of a failed job, None on success.
+# With the stored fingerprints, a job that is up to date is skipped, and a job whose model deferred a call is
+# counted as deferred
+async def RunJob(job: tuple, evaluation_data: str, options: Options, get_llm, sink, stats: dict, stored=None):
+    person, model, baseline = job
+    start = time.perf_counter()
+    current_job.set(job)
+    try:
+        if stored is not None and UpToDate(job, evaluation_data, options, stored):
+            stats["skipped"] += 1
+            return None
+        with Span("job", "job"):
+            result = await GetBaseline(baseline).ARun(os.path.join(evaluation_data, person), get_llm(model), options)
+        if sink is not None and result is not None:
+            sink.Write(person, baseline, result)
+        stats["done"] += 1
+        return None
+    except Deferred:
+        stats["deferred"] += 1
+        return "deferred"
+    except Exception as e:
+        stats["failed"] += 1
+        logger.error(f"{baseline} / {model} / {person} failed: {e!r}")
+        return repr(e)
+    finally:
+        latency = time.perf_counter() - start
+        stats["job_time"] += latency
+        stats["latencies"].append(latency)
+
+
+# A semaphore that hands the free slots to the waiting job that comes first in the job list, so the jobs of the
+# longest baseline still start first when the jobs wait for the inputs of their person
+class PrioritySlots:
+    def __init__(self, slots: int):
+        self.free = slots
+        self.waiters = []
+        self.count = 0
+
+    async def Acquire(self, priority: int) -> None:
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.count += 1
+        heapq.heappush(self.waiters, (priority, self.count, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot was handed over just before the cancellation, it goes to the next job
+            if future.done() and not future.cancelled():
+                self.Release()
+            raise
+
+    def Release(self) -> None:
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+
+# The inputs of a person are loaded once, before its jobs start
+async def LoadInputs(evaluation_folder: str) -> None:
+    LoadData(DataFile(evaluation_folder))
+    LoadQuestions(QuestionFile(evaluation_folder))
+    HashFile(DataFile(evaluation_folder))
+    HashFile(QuestionFile(evaluation_folder))
+
+
+# Every person is a graph: its inputs are loaded once, then every (model, baseline) job of the person runs as a
+# stage that depends on them. The jobs do not depend on each other, so they all run concurrently, across models
+# and baselines, and the critical path of a person is its longest chain (RoleGPT)
+async def RunJobs(jobs: list, evaluation_data: str, concurrency: int, options: Options = None,
+                  get_llm=GetLLM, sink=None) -> dict:
+    slots = PrioritySlots(concurrency)
+    priorities = {job: i for i, job in enumerate(jobs)}
+    stats = {"done": 0, "failed": 0, "skipped": 0, "deferred": 0, "job_time": 0.0, "latencies": []}
+
+    # With prefix stable prompts the first job of every (model, baseline) runs alone, so the prompt prefixes that
+    # are shared by the group are cached by the provider before the rest of the group sends them
+    warm = {}
+    if options is not None and options.prefix_stable:
+        for person, model, baseline in jobs:
+            warm.setdefault((model, baseline), (person, asyncio.Event()))
+
+    async def run(job):
+        person, model, baseline = job
+        first_person, warmed = warm.get((model, baseline), (person, None))
+        if warmed is not None and person != first_person:
+            await warmed.wait()
+        await slots.Acquire(priorities[job])
+        try:
+            await RunJob(job, evaluation_data, options, get_llm, sink, stats)
+        finally:
+            slots.Release()
+            if warmed is not None and person == first_person:
+                warmed.set()
+
+    async def run_person(person: str, person_jobs: list):
+        # The tasks of the graph copy the context, so they all see the inputs of this person
+        person_inputs.set({})
+        graph = Graph()
+        graph.Add("inputs", lambda results: LoadInputs(os.path.join(evaluation_data, person)))
+        for job in person_jobs:
+            graph.Add(job, lambda results, job=job: run(job), ["inputs"])
+        for job, result in (await graph.Run()).items():
+            if isinstance(result, DependencyFailed):
+                stats["failed"] += 1
+                logger.error(f"{job[2]} / {job[1]} / {person} failed: {result.__cause__!r}")
+                # The first job of a group is warming its prefix for the others
+                first_person, warmed = warm.get((job[1], job[2]), (person, None))
+                if warmed is not None and person == first_person:
+                    warmed.set()
+
+    by_person = {}
+    for job in jobs:
+        by_person.setdefault(job[0], []).append(job)
+    start = time.perf_counter()
+    await asyncio.gather(*(run_person(person, person_jobs) for person, person_jobs in by_person.items()))
+    stats["elapsed"] = time.perf_counter() - start
+    return stats
+
+
+def LogThroughput(stats: dict, jobs: list) -> None:
+    elapsed = max(stats["elapsed"], 1e-9)
+    logger.info(f"{stats['done']} done, {stats['failed']} failed, {stats['skipped']} up to date in "
+                f"{stats['elapsed']:.1f}s, "
+                f"{len(jobs) / elapsed:.2f} jobs/s, "
+                f"{stats['job_time'] / elapsed:.1f}x faster than running one by one")
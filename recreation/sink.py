@@ -0,0 +1,94 @@
+from loguru import logger
+import json
+import os
+import time
+
+from recreation.runner import GetBaseline
+from recreation.tracing import Span
+
+
+# An append only JSONL file of results, one line per finished (person, model, baseline) job. Lines are flushed
+# to disk in batches, so a crash loses at most the last batch and never corrupts the lines before it
+class ResultSink:
+    def __init__(self, sink_file: str, fsync_every: int = 64, fsync_interval: float = 2.0):
+        os.makedirs(os.path.dirname(os.path.abspath(sink_file)), exist_ok=True)
+        self.sink_file = sink_file
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.pending = 0
+        self.synced = time.monotonic()
+        self.f = open(sink_file, 'a', encoding='utf-8')
+
+    def Write(self, person: str, baseline: str, result: dict) -> None:
+        with Span("sink_write"):
+            self.f.write(json.dumps({"person": person, "baseline": baseline, "result": result}, ensure_ascii=False)
+                         + "\n")
+            self.pending += 1
+            if self.pending >= self.fsync_every or time.monotonic() - self.synced >= self.fsync_interval:
+                self.Flush()
+
+    def Flush(self) -> None:
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+        self.synced = time.monotonic()
+
+    def Close(self) -> None:
+        self.Flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.Close()
+
+
+# Method of reading the sink with the byte offset of every line, a line cut short by a crash is skipped
+def ReadSinkLines(sink_file: str):
+    offset = 0
+    with open(sink_file, 'rb') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                record = None
+            if record is not None:
+                yield offset, record
+            offset += len(line)
+
+
+def ReadSink(sink_file: str):
+    for _, record in ReadSinkLines(sink_file):
+        yield record
+
+
+# Method of writing the final result file of every person and baseline in the sinks, it holds the results of every
+# model, the later line of a (person, model, baseline) wins so a rerun replaces the older result. The sinks of
+# several workers are merged together, in the given order. Only the place of the latest line of each result is kept
+# in memory, the results are read again and written one final file at a time
+def Merge(sink_files: list, evaluation_data: str) -> int:
+    lines = {}
+    for index, sink_file in enumerate(sink_files):
+        for offset, record in ReadSinkLines(sink_file):
+            lines.setdefault((record["person"], record["baseline"]), {})[record["result"]["model"]] = (index, offset)
+
+    files = [open(sink_file, 'rb') for sink_file in sink_files]
+    try:
+        for (person, baseline), models in lines.items():
+            results = []
+            for model in sorted(models):
+                index, offset = models[model]
+                files[index].seek(offset)
+                results.append(json.loads(files[index].readline())["result"])
+            final_result_file = os.path.join(evaluation_data, person, GetBaseline(baseline).final_result_name)
+            temp_file = final_result_file + ".tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=4)
+            os.replace(temp_file, final_result_file)
+    finally:
+        for f in files:
+            f.close()
+
+    logger.info(f"Merged {sum(len(models) for models in lines.values())} results into {len(lines)} final files")
+    return len(lines)
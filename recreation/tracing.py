@@ -0,0 +1,158 @@
+import contextvars
+import json
+import os
+import time
+
+from recreation.common import current_job, current_stage
+
+# Tracing is off unless a run asks for a trace or metrics file, a span is then a shared object that does nothing
+enabled = False
+spans = []
+# Upper bounds in seconds of the latency histogram buckets of the metrics
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+
+# The arguments of the innermost open span, so the code it calls can add to them (retries, cache hits)
+current_args = contextvars.ContextVar("current_args", default=None)
+origin = time.perf_counter()
+# Every job gets its own track in the trace viewer
+lanes = {}
+
+
+def Enable() -> None:
+    global enabled, origin
+    enabled = True
+    origin = time.perf_counter()
+
+
+class SpanContext:
+    __slots__ = ("name", "category", "args", "start", "token")
+
+    def __init__(self, name: str, category: str, args: dict):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        job = current_job.get()
+        if job is not None:
+            self.args["person"], self.args["model"], self.args["baseline"] = job
+        stage = current_stage.get()
+        if stage is not None:
+            self.args.setdefault("stage", stage)
+        self.token = current_args.set(self.args)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        end = time.perf_counter()
+        current_args.reset(self.token)
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        job = current_job.get()
+        spans.append({"name": self.name, "cat": self.category, "start": self.start - origin,
+                      "duration": end - self.start, "lane": lanes.setdefault(job, len(lanes)) if job else -1,
+                      "args": self.args})
+        return False
+
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+no_span = NoSpan()
+
+
+# Method of timing a block of code, e.g. `with Span("save_checkpoint", "io"):`. The span carries the person, model
+# and baseline of the job and the stage it runs in, plus the given arguments
+def Span(name: str, category: str = "io", **args):
+    if not enabled:
+        return no_span
+    return SpanContext(name, category, args)
+
+
+# Method of adding arguments to the innermost open span, counters are added up
+def Annotate(**args) -> None:
+    if not enabled:
+        return
+    span_args = current_args.get()
+    if span_args is None:
+        return
+    for key, value in args.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and key in span_args:
+            span_args[key] += value
+        else:
+            span_args[key] = value
+
+
+# The spans as a Chrome trace, it opens in chrome://tracing and in Perfetto
+def WriteChromeTrace(trace_file: str) -> None:
+    lane_names = {lane: "/".join(job) for job, lane in lanes.items()}
+    events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": lane + 1, "args": {"name": name}}
+              for lane, name in lane_names.items()]
+    events += [{"name": span["name"], "cat": span["cat"], "ph": "X", "pid": 1, "tid": span["lane"] + 1,
+                "ts": span["start"] * 1e6, "dur": span["duration"] * 1e6, "args": span["args"]} for span in spans]
+    os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+    with open(trace_file, 'w', encoding='utf-8') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False, default=str)
+
+
+def Escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def Labels(labels: dict) -> str:
+    return ",".join(f'{key}="{Escape(value)}"' for key, value in labels.items())
+
+
+# The spans as OpenMetrics text: a latency histogram per span name, category, model and baseline, and the totals
+# of the retries, hedges and cache hits of the LLM calls
+def WriteOpenMetrics(metrics_file: str) -> None:
+    histograms, retries, hedges, cache = {}, {}, {}, {}
+    for span in spans:
+        args = span["args"]
+        key = (span["name"], span["cat"], args.get("model", ""), args.get("baseline", ""))
+        histogram = histograms.setdefault(key, {"counts": [0] * len(buckets), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(buckets):
+            if span["duration"] <= bound:
+                histogram["counts"][i] += 1
+        histogram["sum"] += span["duration"]
+        histogram["count"] += 1
+        if span["cat"] == "llm":
+            retries[key] = retries.get(key, 0) + args.get("retries", 0)
+            hedges[key] = hedges.get(key, 0) + args.get("hedges", 0)
+            if "cache" in args:
+                cache_key = key + (args["cache"],)
+                cache[cache_key] = cache.get(cache_key, 0) + 1
+
+    lines = ["# TYPE echo_span_duration_seconds histogram",
+             "# UNIT echo_span_duration_seconds seconds",
+             "# HELP echo_span_duration_seconds Duration of the chain calls and I/O steps of the baselines."]
+    for (name, category, model, baseline), histogram in sorted(histograms.items()):
+        labels = {"span": name, "category": category, "model": model, "baseline": baseline}
+        for bound, count in zip(buckets, histogram["counts"]):
+            lines.append(f"echo_span_duration_seconds_bucket{{{Labels({**labels, 'le': bound})}}} {count}")
+        lines.append(f"echo_span_duration_seconds_bucket{{{Labels({**labels, 'le': '+Inf'})}}} {histogram['count']}")
+        lines.append(f"echo_span_duration_seconds_sum{{{Labels(labels)}}} {histogram['sum']}")
+        lines.append(f"echo_span_duration_seconds_count{{{Labels(labels)}}} {histogram['count']}")
+
+    lines += ["# TYPE echo_llm_retries counter", "# HELP echo_llm_retries Retries of the LLM calls."]
+    for (name, category, model, baseline), count in sorted(retries.items()):
+        labels = {"span": name, "model": model, "baseline": baseline}
+        lines.append(f"echo_llm_retries_total{{{Labels(labels)}}} {count}")
+    lines += ["# TYPE echo_llm_hedges counter", "# HELP echo_llm_hedges Slow LLM calls that were sent a second time."]
+    for (name, category, model, baseline), count in sorted(hedges.items()):
+        labels = {"span": name, "model": model, "baseline": baseline}
+        lines.append(f"echo_llm_hedges_total{{{Labels(labels)}}} {count}")
+    lines += ["# TYPE echo_llm_cache counter", "# HELP echo_llm_cache LLM calls answered or missed by the cache."]
+    for (name, category, model, baseline, result), count in sorted(cache.items()):
+        labels = {"span": name, "model": model, "baseline": baseline, "result": result}
+        lines.append(f"echo_llm_cache_total{{{Labels(labels)}}} {count}")
+    lines.append("# EOF")
+
+    os.makedirs(os.path.dirname(os.path.abspath(metrics_file)), exist_ok=True)
+    with open(metrics_file, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
@@ -0,0 +1,186 @@
+from typing import Any, List
+from loguru import logger
+import functools
+import json
+import re
+
+from langchain.output_parsers.json import parse_partial_json
+from langchain.output_parsers.openai_functions import JsonOutputFunctionsParser
+from langchain.schema import ChatGeneration, Generation
+
+from recreation.common import ACall, current_stage
+
+# Follow up calls made for the pairs that are still missing or invalid before the stage gives up
+max_repairs = 2
+# Validation and repair counters of each stage of the process
+stats = {}
+
+types = {"object": dict, "array": list, "string": str, "integer": int, "number": (int, float), "boolean": bool}
+
+
+# Method of compiling a JSON schema (the subset the baselines use: type, properties, required, items, minItems,
+# maxItems) into a function that returns the list of errors of a value, an empty list when it is valid
+def Compile(schema: dict):
+    checks = []
+    if "type" in schema:
+        expected = types[schema["type"]]
+
+        # bool is an int in Python but not in JSON
+        def check_type(value, path: str) -> list:
+            if isinstance(value, expected) and (expected is bool or not isinstance(value, bool)):
+                return []
+            return [f"{path}: expected {schema['type']}"]
+        checks.append(check_type)
+    if "required" in schema:
+        required = list(schema["required"])
+        checks.append(lambda value, path: [f"{path}.{key}: missing" for key in required
+                                           if isinstance(value, dict) and key not in value])
+    if "properties" in schema:
+        properties = {key: Compile(value) for key, value in schema["properties"].items()}
+        checks.append(lambda value, path: [error for key, check in properties.items()
+                                           if isinstance(value, dict) and key in value
+                                           for error in check(value[key], f"{path}.{key}")])
+    if "items" in schema:
+        item = Compile(schema["items"])
+        checks.append(lambda value, path: [error for i, element in enumerate(value if isinstance(value, list) else [])
+                                           for error in item(element, f"{path}[{i}]")])
+    if "minItems" in schema or "maxItems" in schema:
+        low, high = schema.get("minItems", 0), schema.get("maxItems", float("inf"))
+        checks.append(lambda value, path: [f"{path}: {len(value)} items, expected {low} to {high}"]
+                      if isinstance(value, list) and not low <= len(value) <= high else [])
+
+    def check(value, path: str = "$") -> list:
+        return [error for c in checks for error in c(value, path)]
+    return check
+
+
+# The schemas are compiled once per process
+@functools.lru_cache(maxsize=None)
+def CompileCached(schema_json: str):
+    return Compile(json.loads(schema_json))
+
+
+def Validator(schema: dict):
+    return CompileCached(json.dumps(schema, sort_keys=True))
+
+
+# A function call output parser that never raises. Arguments that are not valid JSON, e.g. cut short at the token
+# limit, are parsed as far as they go, and an answer without a function call is an empty object, so the pairs that
+# did come back are kept and only the others are asked again
+class LenientFunctionsParser(JsonOutputFunctionsParser):
+    def parse_result(self, result: List[Generation], *, partial: bool = False) -> Any:
+        message = result[0].message if result and isinstance(result[0], ChatGeneration) else None
+        function_call = message.additional_kwargs.get("function_call") if message is not None else None
+        if not function_call:
+            Count("malformed")
+            return {}
+        try:
+            return json.loads(function_call["arguments"], strict=False)
+        except (json.JSONDecodeError, TypeError, KeyError):
+            Count("malformed")
+        # The text is cut back to the end of the last complete object until the rest parses
+        text = function_call.get("arguments") or ""
+        while text:
+            try:
+                output = parse_partial_json(text, strict=False)
+            except Exception:
+                output = None
+            if isinstance(output, dict):
+                return output
+            text = text[:text.rfind("}", 0, len(text) - 1) + 1]
+        return {}
+
+
+def Count(key: str, amount: int = 1, stage: str = None) -> None:
+    stage_stats = stats.setdefault(stage or current_stage.get() or "unknown",
+                                   {"calls": 0, "invalid": 0, "malformed": 0, "repair_calls": 0,
+                                    "repaired_pairs": 0, "failed": 0})
+    stage_stats[key] += amount
+
+
+def Normalize(question) -> str:
+    return re.sub(r"[^a-z0-9]+", " ", str(question).lower()).strip()
+
+
+# Method of putting the returned pairs (None for the invalid ones) in the place of the questions they answer among
+# the missing ones, matched by text, then by position
+def MatchPairs(questions: list, missing: list, returned: list, pairs: list) -> None:
+    asked = {Normalize(questions[i]) for i in missing}
+    by_question = {Normalize(pair["question"]): pair for pair in returned if pair is not None}
+    for position, i in enumerate(missing):
+        pair = by_question.get(Normalize(questions[i]))
+        # A reworded question is taken as the answer to the question asked at its position
+        if pair is None and position < len(returned) and returned[position] is not None and \
+                Normalize(returned[position]["question"]) not in asked:
+            pair = returned[position]
+        if pair is not None:
+            pairs[i] = {**pair, "question": questions[i]}
+
+
+# An answer with every pair asked for, all of them valid. A hedged call only wins its race with such an answer
+def Complete(output_key: str, check, items: int):
+    def valid(outputs) -> bool:
+        output = outputs.get(output_key) if isinstance(outputs, dict) else None
+        returned = output.get("qa_pairs") if isinstance(output, dict) else None
+        return isinstance(returned, list) and len(returned) >= items and not any(check(pair) for pair in returned)
+    return valid
+
+
+# Method of calling a structured QA chain and making sure every pair is valid. make_chain(items) builds the chain
+# that asks for `items` pairs. With questions, the pairs answer them (matched by text, then by position) and the
+# missing or invalid ones are asked again under question_key. Without questions the chain makes up `count` pairs and
+# only the missing number of pairs is asked again. The pairs are returned under "qa_pairs" in order
+async def AValidatedPairs(make_chain, inputs: dict, stage: str, output_key: str, questions: list = None,
+                          count: int = None, question_key: str = "questions_string") -> dict:
+    count = len(questions) if questions is not None else count
+    pairs = [None] * count
+    missing = list(range(count))
+
+    for attempt in range(max_repairs + 1):
+        chain = make_chain(len(missing))
+        check = Validator(chain.llm_kwargs["functions"][0]["parameters"]["properties"]["qa_pairs"]["items"])
+        call_inputs = dict(inputs)
+        if questions is not None:
+            call_inputs[question_key] = "\n".join(questions[i] for i in missing)
+        output = (await ACall(chain, call_inputs, stage, Complete(output_key, check, len(missing))))[output_key]
+        returned = output.get("qa_pairs") if isinstance(output, dict) else None
+        # Invalid pairs keep their position, so the pairs after them still line up with their questions
+        returned = [None if check(pair) else pair for pair in returned] if isinstance(returned, list) else []
+        Count("calls" if attempt == 0 else "repair_calls", stage=stage)
+
+        if questions is None:
+            for i, pair in zip(missing, [pair for pair in returned if pair is not None]):
+                pairs[i] = pair
+        else:
+            MatchPairs(questions, missing, returned, pairs)
+
+        still_missing = [i for i in range(count) if pairs[i] is None]
+        if attempt > 0:
+            Count("repaired_pairs", len(missing) - len(still_missing), stage=stage)
+        missing = still_missing
+        if not missing:
+            return {"qa_pairs": pairs}
+        if attempt == 0:
+            Count("invalid", stage=stage)
+        logger.warning(f"{stage}: {len(missing)} of {count} pairs missing or invalid, asking again for those")
+
+    Count("failed", stage=stage)
+    raise ValueError(f"{stage}: {len(missing)} of {count} pairs still missing or invalid after {max_repairs} repairs")
+
+
+# The pairs of the section of a person in a packed answer, None unless every question has a valid answer
+def SectionPairs(section, questions: list, schema: dict):
+    check = Validator(schema["properties"]["qa_pairs"]["items"])
+    returned = section.get("qa_pairs") if isinstance(section, dict) else None
+    returned = [None if check(pair) else pair for pair in returned] if isinstance(returned, list) else []
+    pairs = [None] * len(questions)
+    MatchPairs(questions, list(range(len(questions))), returned, pairs)
+    return {"qa_pairs": pairs} if all(pair is not None for pair in pairs) else None
+
+
+def LogStats() -> None:
+    for stage, stage_stats in sorted(stats.items()):
+        logger.info(f"{stage}: {stage_stats['calls']} structured calls, {stage_stats['invalid']} needed a repair "
+                    f"({stage_stats['invalid'] / max(stage_stats['calls'], 1):.1%}), {stage_stats['repair_calls']} "
+                    f"repair calls fixed {stage_stats['repaired_pairs']} pairs, {stage_stats['malformed']} malformed "
+                    f"outputs, {stage_stats['failed']} failed")
@@ -0,0 +1,211 @@
+from contextlib import contextmanager
+from loguru import logger
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+
+from recreation.common import GetLLM
+from recreation.runner import RunJob
+
+# A sweep of (person, model, baseline) jobs shared by worker processes, possibly on several machines that see the
+# same file system. A worker leases the jobs it claims and renews the lease while it runs them, the jobs of a
+# worker that stops renewing are given to the others once the lease expires. The clocks of the machines are
+# assumed to be in sync to a few seconds
+default_lease = 600.0
+# A job whose lease expired this many times is failed instead of queued again, e.g. it crashes its worker
+max_attempts = 3
+
+
+def DefaultWorker() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    def __init__(self, queue_file: str):
+        os.makedirs(os.path.dirname(os.path.abspath(queue_file)), exist_ok=True)
+        self.queue_file = queue_file
+        with self.Connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs "
+                "(person TEXT NOT NULL, model TEXT NOT NULL, baseline TEXT NOT NULL, "
+                "state TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_until REAL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, started REAL, finished REAL, error TEXT, "
+                "PRIMARY KEY (person, model, baseline))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS workers "
+                "(worker TEXT PRIMARY KEY, host TEXT, pid INTEGER, started REAL, heartbeat REAL, "
+                "done INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0)"
+            )
+
+    # Every operation opens its own connection, so they can run in worker threads. The journal stays in the default
+    # rollback mode, WAL needs shared memory that a network file system does not have
+    @contextmanager
+    def Connect(self):
+        conn = sqlite3.connect(self.queue_file, timeout=60, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    # Jobs already in the queue keep their state, so a sweep can be extended with more persons or models
+    def Enqueue(self, jobs: list) -> int:
+        with self.Connect() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO jobs (person, model, baseline) VALUES (?, ?, ?)", jobs)
+            return conn.total_changes - before
+
+    # Method of putting the failed jobs back in the queue
+    def Retry(self) -> int:
+        with self.Connect() as conn:
+            return conn.execute("UPDATE jobs SET state = 'pending', attempts = 0, error = NULL, worker = NULL "
+                                "WHERE state = 'failed'").rowcount
+
+    def Register(self, worker: str) -> None:
+        now = time.time()
+        with self.Connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (worker, host, pid, started, heartbeat) "
+                         "VALUES (?, ?, ?, ?, ?)", (worker, socket.gethostname(), os.getpid(), now, now))
+
+    # Method of leasing up to n pending jobs to a worker, in the order they were queued. The expired leases are
+    # queued again first
+    def Claim(self, worker: str, n: int, lease: float = default_lease) -> list:
+        now = time.time()
+        with self.Connect() as conn:
+            conn.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                         "error = 'lease of ' || worker || ' expired', worker = NULL, lease_until = NULL "
+                         "WHERE state = 'running' AND lease_until < ?", (max_attempts, now))
+            jobs = conn.execute("SELECT person, model, baseline FROM jobs WHERE state = 'pending' "
+                                "ORDER BY rowid LIMIT ?", (n,)).fetchall()
+            conn.executemany("UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, started = ?, "
+                             "attempts = attempts + 1, error = NULL WHERE person = ? AND model = ? AND baseline = ?",
+                             [(worker, now + lease, now, *job) for job in jobs])
+            conn.execute("UPDATE workers SET heartbeat = ? WHERE worker = ?", (now, worker))
+        return [tuple(job) for job in jobs]
+
+    # Method of renewing the leases of every job a worker is running
+    def Heartbeat(self, worker: str, lease: float = default_lease) -> None:
+        now = time.time()
+        with self.Connect() as conn:
+            conn.execute("UPDATE jobs SET lease_until = ? WHERE worker = ? AND state = 'running'",
+                         (now + lease, worker))
+            conn.execute("UPDATE workers SET heartbeat = ? WHERE worker = ?", (now, worker))
+
+    # A job is only completed by the worker that holds its lease, False means the lease was lost to another worker
+    def Complete(self, job: tuple, worker: str, error: str = None) -> bool:
+        with self.Connect() as conn:
+            updated = conn.execute("UPDATE jobs SET state = ?, finished = ?, error = ?, lease_until = NULL "
+                                   "WHERE person = ? AND model = ? AND baseline = ? AND worker = ? "
+                                   "AND state = 'running'",
+                                   ("failed" if error else "done", time.time(), error, *job, worker)).rowcount
+            counter = "failed" if error else "done"
+            if updated:
+                conn.execute(f"UPDATE workers SET {counter} = {counter} + 1 WHERE worker = ?", (worker,))
+        return updated > 0
+
+    # Method of handing the running jobs of a worker that stops back to the queue, without waiting for the lease
+    def Release(self, worker: str) -> int:
+        with self.Connect() as conn:
+            return conn.execute("UPDATE jobs SET state = 'pending', worker = NULL, lease_until = NULL, "
+                                "attempts = attempts - 1 WHERE worker = ? AND state = 'running'", (worker,)).rowcount
+
+    # Jobs pending or running on any worker, a worker without jobs waits for them since their lease may expire
+    def Remaining(self) -> int:
+        with self.Connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'running')").fetchone()[0]
+
+    def Models(self) -> list:
+        with self.Connect() as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT model FROM jobs ORDER BY model")]
+
+    def Status(self) -> dict:
+        now = time.time()
+        with self.Connect() as conn:
+            states = dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            running = dict(conn.execute("SELECT worker, COUNT(*) FROM jobs WHERE state = 'running' "
+                                        "GROUP BY worker").fetchall())
+            finished = conn.execute("SELECT MIN(started), MAX(finished) FROM jobs WHERE state = 'done'").fetchone()
+            rows = conn.execute("SELECT worker, host, pid, started, heartbeat, done, failed FROM workers "
+                                "ORDER BY started").fetchall()
+        workers = []
+        for worker, host, pid, started, heartbeat, done, failed in rows:
+            elapsed = max(heartbeat - started, 1e-9)
+            workers.append({"worker": worker, "host": host, "pid": pid, "done": done, "failed": failed,
+                            "running": running.get(worker, 0), "jobs_per_minute": 60 * done / elapsed,
+                            "heartbeat_age": now - heartbeat})
+        elapsed = (finished[1] - finished[0]) if finished[0] is not None else 0.0
+        jobs_per_minute = 60 * states.get("done", 0) / elapsed if elapsed > 0 else 0.0
+        return {"states": states, "total": sum(states.values()), "jobs_per_minute": jobs_per_minute,
+                "workers": workers}
+
+
+def LogStatus(status: dict, lease: float = default_lease) -> None:
+    states = status["states"]
+    remaining = states.get("pending", 0) + states.get("running", 0)
+    eta = f", about {remaining / status['jobs_per_minute']:.0f} min left" \
+        if remaining and status["jobs_per_minute"] else ""
+    logger.info(f"{status['total']} jobs: {states.get('done', 0)} done, {states.get('running', 0)} running, "
+                f"{states.get('pending', 0)} pending, {states.get('failed', 0)} failed, "
+                f"{status['jobs_per_minute']:.1f} jobs/min{eta}")
+    for worker in status["workers"]:
+        # A worker that missed its heartbeats for a whole lease is gone, its jobs go to the others
+        state = "lost" if worker["running"] and worker["heartbeat_age"] > lease else \
+            "running" if worker["running"] else "idle"
+        logger.info(f"{worker['worker']} ({state}): {worker['done']} done, {worker['failed']} failed, "
+                    f"{worker['running']} running, {worker['jobs_per_minute']:.1f} jobs/min, "
+                    f"last seen {worker['heartbeat_age']:.0f}s ago")
+
+
+# Method of running jobs of the queue until none is pending or running anywhere. A worker keeps `concurrency` jobs
+# in flight, claims a new one whenever one finishes and renews its leases every third of the lease. With the stored
+# fingerprints, the jobs that are up to date are completed without running
+async def Work(queue: WorkQueue, worker: str, evaluation_data: str, concurrency: int, options=None, get_llm=GetLLM,
+               sink=None, lease: float = default_lease, poll_interval: float = 10.0, stored=None) -> dict:
+    stats = {"done": 0, "failed": 0, "skipped": 0, "deferred": 0, "job_time": 0.0, "latencies": [], "jobs": []}
+    await asyncio.to_thread(queue.Register, worker)
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(lease / 3)
+            await asyncio.to_thread(queue.Heartbeat, worker, lease)
+
+    running = {}
+    beat = asyncio.create_task(heartbeat())
+    start = time.perf_counter()
+    try:
+        while True:
+            if len(running) < concurrency:
+                for job in await asyncio.to_thread(queue.Claim, worker, concurrency - len(running), lease):
+                    running[asyncio.create_task(RunJob(job, evaluation_data, options, get_llm, sink, stats,
+                                                         stored))] = job
+                    stats["jobs"].append(job)
+            if not running:
+                if not await asyncio.to_thread(queue.Remaining):
+                    break
+                await asyncio.sleep(poll_interval)
+                continue
+            finished, _ = await asyncio.wait(running, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                job = running.pop(task)
+                # The result is on disk before the job is marked done
+                if sink is not None:
+                    sink.Flush()
+                if not await asyncio.to_thread(queue.Complete, job, worker, task.result()):
+                    logger.warning(f"{' / '.join(job)}: the lease expired before the job finished")
+    finally:
+        beat.cancel()
+        for task in running:
+            task.cancel()
+        if running:
+            queue.Release(worker)
+        queue.Heartbeat(worker, lease)
+    stats["elapsed"] = time.perf_counter() - start
+    return stats
@@ -0,0 +1,49 @@
+import json
+import os
+
+from recreation.batch import BatchStore, Compile, ResultsFile, Simulate
+from recreation.common import Options
+
+persons = ["Alice_Smith", "Bob_Jones"]
+model = "gpt-4-1106-preview"
+
+
+def EvaluationData(tmp_path) -> str:
+    evaluation_data = str(tmp_path / "evaluation_data")
+    for person in persons:
+        folder = os.path.join(evaluation_data, person)
+        os.makedirs(folder)
+        with open(os.path.join(folder, "background_info.json"), 'w', encoding='utf-8') as f:
+            json.dump({"Name": person.replace("_", " "), "Hobbies": "sailing and chess"}, f)
+        with open(os.path.join(folder, "evaluation_questions.json"), 'w', encoding='utf-8') as f:
+            json.dump({"qa_pairs": [{"question": f"Question {i} about sailing?", "answer": "x"} for i in range(3)]}, f)
+    return evaluation_data
+
+
+# Every round compiles the requests of the next stage, the local stand-in answers them and the answers are ingested,
+# until every job has its result
+def test_compile_simulate_ingest_round_trip(tmp_path):
+    evaluation_data = EvaluationData(tmp_path)
+    store = BatchStore(str(tmp_path / "batch"))
+    jobs = [(person, model, baseline) for person in persons for baseline in ["RoleGPT", "RPP", "Juliet"]]
+
+    rounds = []
+    for _ in range(6):
+        stats = Compile(store, jobs, evaluation_data, Options())
+        rounds.append((stats["done"], stats["deferred"], stats["requests"]))
+        if not stats["files"]:
+            break
+        for requests_file in stats["files"]:
+            results_file = ResultsFile(store.batch_dir, requests_file)
+            lines = Simulate(requests_file, results_file)
+            assert store.Ingest(results_file) == {"answers": lines, "errors": 0, "skipped": 0}
+            # A result file is only ingested once
+            assert store.Ingest(results_file) == {"answers": 0, "errors": 0, "skipped": 0}
+    store.Close()
+
+    assert rounds[0] == (0, len(jobs), 6)
+    assert rounds[-1][:2] == (len(jobs), 0)
+    assert not store.pending
+    for person in persons:
+        with open(os.path.join(evaluation_data, person, model + "_RoleGPT_QA.json"), 'r', encoding='utf-8') as f:
+            assert len(json.load(f)["Answers"]["qa_pairs"]) == 3
@@ -0,0 +1,19 @@
+import asyncio
+
+from recreation.checkpoint import Checkpoint
+
+
+# The lock of a shared stage that was contended in one event loop is not reused by the next one
+def test_shared_stage_lock_in_several_event_loops(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path), "RoleGPT", "gpt-4-1106-preview", ("QA",))
+
+    async def hold():
+        async with checkpoint.Lock("QA"):
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(hold(), hold())
+
+    for _ in range(3):
+        asyncio.run(main())
+    assert len(Checkpoint.locks) <= 1
@@ -0,0 +1,52 @@
+import asyncio
+
+from recreation import pack
+from recreation.pack import AnswerPacked, GetPacker
+
+
+# A packed call that fails the section of the given items, and a single call that answers any item alone
+def Calls(failing: set):
+    packs, singles = [], []
+
+    async def call(items: list) -> list:
+        packs.append(list(items))
+        return [None if item in failing else f"packed {item}" for item in items]
+
+    async def single(item):
+        singles.append(item)
+        if item == "error":
+            raise ValueError(item)
+        return f"single {item}"
+
+    return call, single, packs, singles
+
+
+# The failed persons are split in two and packed again, a person left alone gets the single call
+def test_failed_sections_are_halved():
+    call, single, packs, singles = Calls({"b", "c", "d"})
+    answers = asyncio.run(AnswerPacked("test", ["a", "b", "c", "d"], call, single))
+    assert answers == ["packed a", "single b", "single c", "single d"]
+    assert packs == [["a", "b", "c", "d"], ["c", "d"]]
+    assert sorted(singles) == ["b", "c", "d"]
+
+
+# The error of a single call is the answer of its person only
+def test_error_of_a_single_call_stays_with_its_person():
+    call, single, _, _ = Calls({"error"})
+    answers = asyncio.run(AnswerPacked("test", ["a", "error"], call, single))
+    assert answers[0] == "packed a"
+    assert isinstance(answers[1], ValueError)
+
+
+# A full pack is sent at once, a person alone is sent after the linger as a single call
+def test_packer_sends_full_packs_and_lingers(monkeypatch):
+    monkeypatch.setattr(pack, "linger", 0.01)
+    call, single, packs, singles = Calls(set())
+
+    async def main():
+        packer = GetPacker("test", "fake", 2, call, single)
+        return await asyncio.gather(packer.Ask("a"), packer.Ask("b"), packer.Ask("c"))
+
+    assert asyncio.run(main()) == ["packed a", "packed b", "single c"]
+    assert packs == [["a", "b"]]
+    assert singles == ["c"]
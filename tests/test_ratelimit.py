@@ -0,0 +1,59 @@
+import asyncio
+import random
+
+from recreation.ratelimit import HedgePolicy, ModelLimiter, Scheduler
+
+
+# A normal mix of short text calls and long structured calls, without any 429, must not look like congestion
+def test_mixed_latencies_do_not_shrink_the_limit():
+    rng = random.Random(0)
+    limiter = ModelLimiter("gpt-4-1106-preview", concurrency=16, max_concurrency=64)
+    for _ in range(2000):
+        if rng.random() < 0.4:
+            limiter.OnSuccess(rng.uniform(2.5, 3.5), "description_2")
+        else:
+            limiter.OnSuccess(rng.uniform(18.0, 22.0), "QA")
+    assert limiter.limit >= 16
+
+
+# A stage whose latency drifts far above its best one still makes the limit shrink
+def test_slower_stage_shrinks_the_limit():
+    limiter = ModelLimiter("gpt-4-1106-preview", concurrency=16, max_concurrency=64)
+    for _ in range(50):
+        limiter.OnSuccess(3.0, "QA")
+    before = limiter.limit
+    for _ in range(50):
+        limiter.OnSuccess(30.0, "QA")
+    assert limiter.limit < before
+
+
+# The first answer of a hedged call is not valid (e.g. a function call cut short), the hedge keeps running and wins
+def test_invalid_answer_does_not_win_the_hedge():
+    scheduler = Scheduler(hedging=HedgePolicy(budget=1.0, min_samples=1))
+    scheduler.hedging.Record(("gpt-4-1106-preview", "QA"), 0.01)
+    answers = iter([(0.05, {"valid": False}), (0.1, {"valid": True})])
+
+    async def call():
+        delay, answer = next(answers)
+        await asyncio.sleep(delay)
+        return answer
+
+    result = asyncio.run(scheduler.Run("gpt-4-1106-preview", 10, call, "QA", lambda answer: answer["valid"]))
+    assert result == {"valid": True}
+    assert scheduler.Limiter("gpt-4-1106-preview").stats["hedges_won"] == 1
+
+
+# Without a valid answer the first one that came back goes to the repairs of the caller
+def test_no_valid_answer_returns_the_first_one():
+    scheduler = Scheduler(hedging=HedgePolicy(budget=1.0, min_samples=1))
+    scheduler.hedging.Record(("gpt-4-1106-preview", "QA"), 0.01)
+    answers = iter([(0.05, {"valid": False, "first": True}), (0.1, {"valid": False, "first": False})])
+
+    async def call():
+        delay, answer = next(answers)
+        await asyncio.sleep(delay)
+        return answer
+
+    result = asyncio.run(scheduler.Run("gpt-4-1106-preview", 10, call, "QA", lambda answer: answer["valid"]))
+    assert result["first"]
+    assert scheduler.Limiter("gpt-4-1106-preview").stats["hedges_wasted"] == 1
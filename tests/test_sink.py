@@ -0,0 +1,32 @@
+import json
+import os
+
+from recreation.sink import Merge, ReadSink, ResultSink
+
+
+def Result(model: str, answer: str) -> dict:
+    return {"Baseline": "Role-Playing Prompting", "model": model, "Answers": {"qa_pairs": [{"answer": answer}]}}
+
+
+# The latest line of every (person, model, baseline) wins, across the sinks of several workers and a line cut short
+def test_merge_writes_the_latest_result_of_every_model(tmp_path):
+    for person in ["Alice", "Bob"]:
+        os.makedirs(tmp_path / person)
+    first, second = str(tmp_path / "worker-0.jsonl"), str(tmp_path / "worker-1.jsonl")
+    with ResultSink(first) as sink:
+        sink.Write("Alice", "RPP", Result("gpt-4-1106-preview", "old"))
+        sink.Write("Alice", "RPP", Result("gpt-3.5-turbo-1106", "ü"))
+        sink.Write("Bob", "RPP", Result("gpt-4-1106-preview", "bob"))
+    with ResultSink(second) as sink:
+        sink.Write("Alice", "RPP", Result("gpt-4-1106-preview", "new"))
+    with open(second, 'a', encoding='utf-8') as f:
+        f.write('{"person": "Bob", "baseline": "RPP", "res')
+
+    assert Merge([first, second], str(tmp_path)) == 2
+    with open(tmp_path / "Alice" / "Better_Zero_Shot_QA.json", 'r', encoding='utf-8') as f:
+        alice = json.load(f)
+    assert [(result["model"], result["Answers"]["qa_pairs"][0]["answer"]) for result in alice] == \
+           [("gpt-3.5-turbo-1106", "ü"), ("gpt-4-1106-preview", "new")]
+    with open(tmp_path / "Bob" / "Better_Zero_Shot_QA.json", 'r', encoding='utf-8') as f:
+        assert [result["Answers"]["qa_pairs"][0]["answer"] for result in json.load(f)] == ["bob"]
+    assert len(list(ReadSink(second))) == 1
@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+import pytest
+from langchain.chains.openai_functions import create_structured_output_chain
+from langchain.prompts import ChatPromptTemplate
+
+from recreation import validation
+from recreation.common import QASchema
+from recreation.fake import FakeChatModel
+from recreation.validation import AValidatedPairs, LenientFunctionsParser
+
+questions = [f"Question {i} about your life?" for i in range(10)]
+
+
+# A fake model whose answers break the pairs at the given positions, one list of positions per call. The calls past
+# the list are answered in full
+class BreakingModel(FakeChatModel):
+    broken: list = []
+    # Broken pairs are left out of the answer instead of given an invalid answer
+    drop: bool = False
+
+    def Respond(self, messages, functions=None, function_call=None, **kwargs):
+        result = super().Respond(messages, functions, function_call, **kwargs)
+        if functions and len(self.calls) <= len(self.broken):
+            function_call = result.generations[0].message.additional_kwargs["function_call"]
+            arguments = json.loads(function_call["arguments"])
+            positions = self.broken[len(self.calls) - 1]
+            pairs = [{**pair, "answer": 0} if i in positions else pair for i, pair in enumerate(arguments["qa_pairs"])]
+            if self.drop:
+                pairs = [pair for i, pair in enumerate(arguments["qa_pairs"]) if i not in positions]
+            function_call["arguments"] = json.dumps({"qa_pairs": pairs})
+        return result
+
+
+def Validated(llm, questions: list = None, count: int = None) -> dict:
+    prompt = ChatPromptTemplate.from_messages([("human", "Answer every question.\n{questions_string}")])
+
+    def make_chain(items: int):
+        return create_structured_output_chain(output_schema=QASchema("Test", items=items), llm=llm, prompt=prompt,
+                                              output_key="output", output_parser=LenientFunctionsParser())
+
+    return asyncio.run(AValidatedPairs(make_chain, {"questions_string": ""}, "test", "output", questions, count))
+
+
+# Only the invalid pairs are asked again, and the repaired ones go back to the place of their questions
+def test_invalid_pairs_are_repaired():
+    llm = BreakingModel(model_name="fake", broken=[[2, 5]])
+    pairs = Validated(llm, questions)["qa_pairs"]
+    assert [pair["question"] for pair in pairs] == questions
+    assert all(isinstance(pair["answer"], str) for pair in pairs)
+    assert len(llm.calls) == 2
+    repair = llm.calls[1]
+    assert repair["functions"][0]["parameters"]["properties"]["qa_pairs"]["minItems"] == 2
+    assert repair["messages"][-1].content.endswith(f"{questions[2]}\n{questions[5]}")
+
+
+# Without questions only the missing number of pairs is asked again
+def test_missing_pairs_are_counted_again():
+    llm = BreakingModel(model_name="fake", broken=[[0, 1, 2]], drop=True)
+    pairs = Validated(llm, count=10)["qa_pairs"]
+    assert len(pairs) == 10 and all(pair is not None for pair in pairs)
+    assert llm.calls[1]["functions"][0]["parameters"]["properties"]["qa_pairs"]["minItems"] == 3
+
+
+# A pair that is still invalid after the repairs fails the stage
+def test_failure_after_max_repairs():
+    llm = BreakingModel(model_name="fake", broken=[[4]] + [[0]] * validation.max_repairs)
+    with pytest.raises(ValueError, match="1 of 10 pairs still missing or invalid"):
+        Validated(llm, questions)
+    assert len(llm.calls) == validation.max_repairs + 1
@@ -0,0 +1,41 @@
+from recreation import workqueue
+from recreation.workqueue import WorkQueue
+
+job = ("Alice_Smith", "gpt-4-1106-preview", "RPP")
+
+
+def Queue(tmp_path) -> WorkQueue:
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    queue.Enqueue([job])
+    return queue
+
+
+# A lease that expired puts the job back in the queue for another worker
+def test_expired_lease_requeues_the_job(tmp_path):
+    queue = Queue(tmp_path)
+    assert queue.Claim("worker-1", 1, lease=-1.0) == [job]
+    assert queue.Claim("worker-2", 1) == [job]
+    # The first worker lost the lease, it cannot complete the job any more
+    assert not queue.Complete(job, "worker-1")
+    assert queue.Complete(job, "worker-2")
+    assert queue.Status()["states"] == {"done": 1}
+
+
+# A job whose lease expired max_attempts times is failed instead of queued again
+def test_job_fails_after_max_attempts(tmp_path):
+    queue = Queue(tmp_path)
+    for attempt in range(workqueue.max_attempts):
+        assert queue.Claim(f"worker-{attempt}", 1, lease=-1.0) == [job]
+    assert queue.Claim("worker-last", 1) == []
+    assert queue.Status()["states"] == {"failed": 1}
+    assert queue.Remaining() == 0
+
+
+# A job released by a worker that stops does not use up an attempt
+def test_release_does_not_use_an_attempt(tmp_path):
+    queue = Queue(tmp_path)
+    for attempt in range(workqueue.max_attempts + 2):
+        assert queue.Claim(f"worker-{attempt}", 1) == [job]
+        assert queue.Release(f"worker-{attempt}") == 1
+    assert queue.Claim("worker-last", 1, lease=-1.0) == [job]
+    assert queue.Claim("worker-next", 1) == [job]